@@ -1,18 +1,78 @@
 from fastapi import FastAPI, File, UploadFile, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import threading
 import webbrowser
 import os
+import json
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-import yt_dlp
-
-from scripts.entrypoint import get_video_file, get_preview_image
-
-app = FastAPI()
+from scripts.entrypoint import get_video_files, analysis_cache, upload_store, upload_index, video_store, workspaces
+from scripts.uploads import is_content_hash, UPLOAD_CHUNK_BYTES
+from scripts.preview import get_preview_image, get_frame_data_chunk, preview_cache, PREVIEW_FORMATS
+from scripts.jobs import JobManager, FINISHED_STATES
+from scripts.render_pool import RenderPool
+from scripts.metrics import register_collector, render_metrics
+from scripts.outputs import get_profiles
+from scripts.downloads import DownloadManager, get_audio_filename, is_video_id
+
+# Number of videos that are rendered at the same time, further jobs wait in a queue.
+# While one video is decoded or muxed, the frames of another keep the workers busy.
+MAX_CONCURRENT_RENDERS = int(os.environ.get("MAX_CONCURRENT_RENDERS", 2))
+
+# How often an item of a batch is tried before it counts as failed
+BATCH_ATTEMPTS = int(os.environ.get("BATCH_ATTEMPTS", 3))
+
+# Number of render processes shared by all jobs, defaults to the number of cores
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 0)) or None
+
+# Settings the analysis behind /frame-data needs, spectrum also needs bins
+FRAME_DATA_REQUIRED_SETTINGS = ("visualization", "framerate", "startEnd", "minMaxFrequency", "smoothing")
+
+VIDEO_MEDIA_TYPES = {".mp4": "video/mp4", ".mkv": "video/x-matroska", ".webm": "video/webm", ".gif": "image/gif"}
+
+job_manager = JobManager(max_concurrent_jobs=MAX_CONCURRENT_RENDERS)
+render_pool = RenderPool(num_workers=RENDER_WORKERS)
+download_manager = DownloadManager(upload_store, workspaces)
+
+def collect_server_metrics():
+    analysis = analysis_cache.stats()
+    preview = preview_cache.stats()
+    stores = { "upload": upload_store.stats(), "video": video_store.stats() }
+    pool = render_pool.stats()
+    downloads = download_manager.stats()
+    return [
+        ("visualizer_cache_hits_total", "counter", "Cache hits", [({"cache": "analysis"}, analysis["hits"]), ({"cache": "preview"}, preview["hits"]), ({"cache": "youtube_metadata"}, downloads["metadata"]["hits"])]),
+        ("visualizer_cache_misses_total", "counter", "Cache misses", [({"cache": "analysis"}, analysis["misses"]), ({"cache": "preview"}, preview["misses"]), ({"cache": "youtube_metadata"}, downloads["metadata"]["misses"])]),
+        ("visualizer_cache_bytes", "gauge", "Size of a cache", [({"cache": "analysis"}, analysis["bytes"]), ({"cache": "preview"}, preview["bytes"])]),
+        ("visualizer_storage_bytes", "gauge", "Size of the stored files", [({"store": name}, stats["bytes"]) for name, stats in stores.items()]),
+        ("visualizer_storage_evictions_total", "counter", "Files deleted to stay within the quota or age limit", [({"store": name}, stats["evictions"]) for name, stats in stores.items()]),
+        ("visualizer_jobs", "gauge", "Render jobs per status", [({"status": status}, count) for status, count in job_manager.stats().items()]),
+        ("visualizer_downloads", "gauge", "YouTube downloads per status", [({"status": status}, count) for status, count in downloads["downloads"].items()]),
+        ("visualizer_render_pool_workers", "gauge", "Processes of the render pool", [({}, pool["workers"])]),
+        ("visualizer_render_pool_tasks", "gauge", "Tasks queued or running in the render pool", [({}, pool["tasks"])]),
+        ("visualizer_render_pool_jobs", "gauge", "Jobs with tasks waiting for a worker", [({}, pool["jobs"])]),
+    ]
+
+register_collector(collect_server_metrics)
+
+@asynccontextmanager
+async def lifespan(app):
+    workspaces.clean()
+    upload_store.evict()
+    video_store.evict()
+    render_pool.start()
+    yield
+    download_manager.shutdown()
+    job_manager.shutdown()
+    render_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,9 +80,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Frame-Start", "X-Frame-Count", "X-Frame-Values", "X-Total-Frames"],
 )
 
-app.mount("/video", StaticFiles(directory="video"), name="video")
+app.mount("/video", StaticFiles(directory=video_store.directory), name="video")
 
 def get_base_url(request: Request):
     return str(request.base_url).rstrip("/")
@@ -41,43 +102,65 @@ async def get_youtube_metadata(request: Request):
     if not video_url:
         return JSONResponse(content={"error": "videoURL is required"}, status_code=400)
 
-    ydl_opts = {
-        'quiet': True,
-        'extract_flat': True,
-    }
-
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(video_url, download=False)
-
-            if 'entries' in info_dict:
-                video = info_dict['entries'][0]
-            else:
-                video = info_dict
-
-            metadata = {
-                "title": video.get("title"),
-                "uploader": video.get("uploader"),
-                "duration": video.get("duration"),
-                "url": video.get("original_url"),
-                "thumbnail": video.get("thumbnail"),
-                "id": video.get("id"),
-            }
-
-            return metadata
+        return await asyncio.to_thread(download_manager.get_metadata, video_url)
     except Exception as e:
         return JSONResponse(content={"error": f"Failed to fetch metadata: {str(e)}"}, status_code=500)
 
+async def save_upload(chunks, name):
+    # Writes the upload to disk while hashing it, the file is then stored under its hash
+    temp_path = upload_index.get_temp_path()
+    digest = hashlib.sha256()
+    with upload_store.pin(temp_path):
+        try:
+            with open(temp_path, "wb") as f:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+            filename = upload_index.add(temp_path, digest.hexdigest(), name)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    try:
+        info = await asyncio.to_thread(upload_index.get_info, filename)
+    except ValueError as e:
+        # Nothing could be rendered from it, so it is not kept
+        upload_index.remove(filename)
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return { "message": "Audio uploaded successfully!", "filename": filename, "hash": digest.hexdigest(), **info }
+
 @app.post("/upload-audio")
 async def upload_audio(file: UploadFile = File(...)):
-    upload_directory = "upload"
-    os.makedirs(upload_directory, exist_ok=True)
-    file_path = os.path.join(upload_directory, file.filename)
+    async def chunks():
+        while chunk := await file.read(UPLOAD_CHUNK_BYTES):
+            yield chunk
 
-    with open(file_path, "wb") as f:
-        f.write(await file.read())
+    return await save_upload(chunks(), os.path.basename(file.filename))
 
-    return { "message": "Audio uploaded successfully!" }
+@app.put("/upload-audio/{filename}")
+async def upload_audio_stream(filename: str, request: Request):
+    # The request body is the file itself, so it goes to disk without being spooled first
+    return await save_upload(request.stream(), os.path.basename(filename))
+
+@app.post("/upload-audio/check")
+async def check_uploaded_audio(request: Request):
+    # Lets clients skip uploading a file the server already has
+    data = await request.json()
+    name = data.get("filename")
+    content_hash = data.get("hash")
+
+    if not name or not is_content_hash(content_hash):
+        return JSONResponse(content={"error": "Filename and SHA-256 hash required"}, status_code=400)
+
+    filename = upload_index.find(content_hash, name)
+    if filename is None:
+        return { "exists": False }
+
+    upload_index.add_name(os.path.basename(name), filename)
+    upload_store.touch(upload_store.path(filename))
+    info = await asyncio.to_thread(upload_index.get_info, filename)
+    return { "exists": True, "filename": filename, **info }
 
 @app.post("/upload-audio-from-url")
 async def upload_audio_from_url(request: Request):
@@ -87,80 +170,294 @@ async def upload_audio_from_url(request: Request):
     if not audio_url_id:
         return {"error": "No YouTube video ID provided"}
 
-    upload_directory = "upload"
-    os.makedirs(upload_directory, exist_ok=True)
+    if not is_video_id(audio_url_id):
+        return {"error": "Invalid YouTube video ID"}
 
-    file_path = os.path.join(upload_directory, f"{audio_url_id}")
+    filename = get_audio_filename(audio_url_id)
+    job = download_manager.download(audio_url_id)
+    if job is None:
+        return { "message": "Audio already exists!", "filename": filename }
 
-    if os.path.exists(file_path + ".mp3"):
-        return { "message": "Audio already exists!" }
+    # Without waiting, the progress of the download is at /downloads/{download_id}
+    if not data.get("wait", True):
+        return { "message": "Download started", "filename": filename, "download_id": job.id }
 
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': file_path,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-    }
+    # A client that goes away does not cancel the download, other requests may wait for it
+    await asyncio.wait([asyncio.wrap_future(job.future)])
+    _, state = job.snapshot()
+    if state["status"] != "done":
+        return { "error": f"Failed to download audio: {state['error'] or state['status']}" }
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(audio_url_id, download=True)
-            filename = ydl.prepare_filename(info_dict)
+    return { "message": "Audio uploaded successfully!", "filename": filename }
 
-        return { "message": "Audio uploaded successfully!" }
+@app.get("/downloads/{download_id}")
+async def get_download(download_id: str):
+    job = download_manager.get(download_id)
+    if job is None:
+        return JSONResponse(content={"error": "Download not found"}, status_code=404)
 
-    except Exception as e:
-        return { "error": f"Failed to download audio: {str(e)}" }
+    _, state = job.snapshot()
+    return state
+
+@app.get("/downloads/{download_id}/events")
+async def get_download_events(download_id: str, request: Request):
+    job = download_manager.get(download_id)
+    if job is None:
+        return JSONResponse(content={"error": "Download not found"}, status_code=404)
+
+    return get_event_stream_response(request, job.snapshot)
+
+@app.post("/downloads/{download_id}/cancel")
+async def cancel_download(download_id: str):
+    job = download_manager.cancel(download_id)
+    if job is None:
+        return JSONResponse(content={"error": "Download not found"}, status_code=404)
+
+    return { "message": "Download cancelled" }
 
 @app.post("/generate-preview-image")
 async def generate_preview_image(request: Request):
     data = await request.json()
     settings = data.get("settings")
+    filename = data.get("filename")
+    timestamp = data.get("timestamp")
+    image_format = data.get("format", "jpeg")
 
     if not settings:
         return {"error": "Settings are required"}
-
-    filename = get_preview_image(settings)
-
-    image_path = os.path.join("scripts", filename)
-    if not os.path.exists(image_path):
-        return {"error": "Preview image not found"}
-
-    file = open(image_path, "rb")
-    return StreamingResponse(file, media_type="image/png")
+    if image_format not in PREVIEW_FORMATS:
+        return JSONResponse(content={"error": f"Unsupported format: {image_format}"}, status_code=400)
+
+    # Without a track, the preview shows the bundled sample audio
+    audio_path = None
+    if filename:
+        audio_path = upload_store.path(upload_index.resolve(os.path.basename(filename)))
+        if not os.path.exists(audio_path):
+            return JSONResponse(content={"error": "Audio file not found"}, status_code=404)
+
+    # The first preview of a track analyzes it, which must not block the event loop
+    image, media_type = await asyncio.to_thread(get_preview_image, settings, audio_path, timestamp, image_format)
+    return Response(content=image, media_type=media_type)
+
+@app.post("/frame-data")
+async def get_frame_data(request: Request):
+    data = await request.json()
+    settings = data.get("settings")
+    filename = data.get("filename")
+
+    if not settings or not filename:
+        return JSONResponse(content={"error": "Filename and settings are required"}, status_code=400)
+    missing = [key for key in FRAME_DATA_REQUIRED_SETTINGS if key not in settings]
+    if settings.get("visualization") == "spectrum" and "bins" not in settings:
+        missing.append("bins")
+    if missing:
+        return JSONResponse(content={"error": f"Missing settings: {', '.join(missing)}"}, status_code=400)
+    try:
+        framerate = int(settings["framerate"])
+        # Ten seconds of frames by default
+        start = int(data.get("start", 0))
+        count = int(data.get("frames", framerate * 10))
+    except (ValueError, TypeError):
+        return JSONResponse(content={"error": "framerate, start and frames must be integers"}, status_code=400)
+    if framerate <= 0 or start < 0 or count <= 0:
+        return JSONResponse(content={"error": "framerate and frames must be positive and start must not be negative"}, status_code=400)
+    if not is_range(settings["startEnd"]) or not is_range(settings["minMaxFrequency"]):
+        return JSONResponse(content={"error": "startEnd and minMaxFrequency must be lists of two numbers"}, status_code=400)
+
+    audio_path = upload_store.path(upload_index.resolve(os.path.basename(filename)))
+    if not os.path.exists(audio_path):
+        return JSONResponse(content={"error": "Audio file not found"}, status_code=404)
+
+    # The first chunk of a track analyzes it, which must not block the event loop
+    frames, start, count, values, total = await asyncio.to_thread(get_frame_data_chunk, audio_path, settings, start, count)
+    # zlib data is what HTTP calls deflate, so browsers decompress it on their own
+    return Response(content=frames, media_type="application/octet-stream", headers={
+        "Content-Encoding": "deflate",
+        "X-Frame-Start": str(start),
+        "X-Frame-Count": str(count),
+        "X-Frame-Values": str(values),
+        "X-Total-Frames": str(total),
+    })
+
+@app.get("/audio/{filename}")
+async def get_audio(filename: str):
+    # Uploaded tracks for playback in the browser
+    audio_path = upload_store.path(upload_index.resolve(os.path.basename(filename)))
+    if not os.path.exists(audio_path):
+        return JSONResponse(content={"error": "Audio file not found"}, status_code=404)
+    upload_store.touch(audio_path)
+    return FileResponse(audio_path)
+
+@app.get("/storage/stats")
+async def get_storage_stats():
+    return { "upload": upload_store.stats(), "video": video_store.stats() }
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format, scraping lists the storage directories so it runs in a thread
+    metrics = await asyncio.to_thread(render_metrics)
+    return Response(content=metrics, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/preview-cache/stats")
+async def get_preview_cache_stats():
+    return preview_cache.stats()
+
+def is_range(value):
+    return isinstance(value, list) and len(value) == 2 and all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in value)
+
+def render_video_job(filename, settings, outputs, progress, cancel_event):
+    video_filenames = get_video_files(filename, settings, outputs, progress=progress, cancel_event=cancel_event, render_pool=render_pool)
+    if not all(os.path.exists(video_store.path(video_filename)) for video_filename in video_filenames):
+        raise FileNotFoundError("Video file not found")
+    return video_filenames
+
+def get_job_state(job, request: Request):
+    version, state = job.snapshot()
+    if state["status"] == "done":
+        timestamp = int(datetime.utcnow().timestamp())
+        state["video_urls"] = [f"{get_base_url(request)}/video/{video_filename}?t={timestamp}" for video_filename in state["result"]]
+        state["video_url"] = state["video_urls"][0]
+    return version, state
 
 @app.post("/generate-video")
 async def generate_video(request: Request):
     data = await request.json()
     filename = data.get("filename") 
     settings = data.get("settings")
+    outputs = data.get("outputs")
 
     if not filename or not settings:
         return {"error": "Filename and settings required"}
+    try:
+        get_profiles(settings, outputs)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        return {"error": f"Invalid outputs: {str(e)}"}
 
-    filename = get_video_file(filename, settings)
+    job = job_manager.submit(render_video_job, filename, settings, outputs)
+    return { "job_id": job.id }
 
-    video_path = os.path.join("video", filename)
-    if not os.path.exists(video_path):
-        return {"error": "Video file not found"}
-    
-    timestamp = int(datetime.utcnow().timestamp())
-    video_url = f"{get_base_url(request)}/video/{filename}?t={timestamp}"
-    return { "video_url": video_url }
+@app.post("/generate-batch")
+async def generate_batch(request: Request):
+    # Either items with a filename and settings each, or filenames and settings that are
+    # used as a template. Items can override the settings of the template.
+    data = await request.json()
+    template = data.get("settings") or {}
+    template_outputs = data.get("outputs")
+    items = data.get("items") or [{"filename": filename} for filename in data.get("filenames") or []]
+
+    if not items:
+        return JSONResponse(content={"error": "Items or filenames required"}, status_code=400)
+
+    # Tracks whose duration is not known yet are probed, which must not block the event loop
+    try:
+        jobs = await asyncio.to_thread(get_batch_jobs, items, template, template_outputs)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    video_names = [settings["fileName"] for _, settings, _ in jobs]
+    if len(set(video_names)) < len(video_names):
+        return JSONResponse(content={"error": "Items need different file names"}, status_code=400)
+
+    batch = job_manager.submit_batch(render_video_job, jobs, max_attempts=BATCH_ATTEMPTS)
+    return { "batch_id": batch.id, "job_ids": [job.id for job in batch.jobs] }
+
+def get_batch_jobs(items, template, template_outputs):
+    jobs = []
+    for index, item in enumerate(items):
+        try:
+            jobs.append(get_batch_job(item, template, template_outputs))
+        except (ValueError, TypeError, KeyError, AttributeError, FileNotFoundError) as e:
+            raise ValueError(f"Item {index}: {str(e)}")
+    return jobs
+
+def get_batch_job(item, template, template_outputs):
+    filename = item["filename"]
+    stored_filename = upload_index.resolve(os.path.basename(filename))
+    if not os.path.exists(upload_store.path(stored_filename)):
+        raise FileNotFoundError(f"Audio file not found: {filename}")
+
+    settings = {**template, **(item.get("settings") or {})}
+    # Without a name or time range, a video is named after its track and covers all of it
+    if not settings.get("fileName"):
+        settings["fileName"] = os.path.splitext(os.path.basename(filename))[0]
+    if not settings.get("startEnd"):
+        settings["startEnd"] = [0, upload_index.get_info(stored_filename)["duration"]]
+    outputs = item.get("outputs", template_outputs)
+    get_profiles(settings, outputs)
+    return filename, settings, outputs
+
+@app.get("/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    batch = job_manager.get_batch(batch_id)
+    if batch is None:
+        return JSONResponse(content={"error": "Batch not found"}, status_code=404)
+
+    return batch.snapshot(lambda job: get_job_state(job, request)[1])
+
+@app.post("/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    batch = job_manager.cancel_batch(batch_id)
+    if batch is None:
+        return JSONResponse(content={"error": "Batch not found"}, status_code=404)
+
+    return { "message": "Batch cancelled" }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, request: Request):
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+
+    _, state = get_job_state(job, request)
+    return state
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, request: Request):
+    job = job_manager.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+
+    return get_event_stream_response(request, lambda: get_job_state(job, request))
+
+def get_event_stream_response(request: Request, get_state):
+    # Sends the state get_state() returns as (version, state) whenever it changes, until
+    # the job is finished
+    async def event_stream():
+        last_version = None
+        while True:
+            version, state = get_state()
+            if version != last_version:
+                last_version = version
+                yield f"data: {json.dumps(state)}\n\n"
+            if state["status"] in FINISHED_STATES or await request.is_disconnected():
+                break
+            await asyncio.sleep(0.25)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+
+    return { "message": "Job cancelled" }
+
+@app.get("/analysis-cache/stats")
+async def get_analysis_cache_stats():
+    return analysis_cache.stats()
 
 @app.get("/download-video/{filename}")
 async def download_video(filename: str):
-    video_path = os.path.join("video", filename)
+    video_path = video_store.path(filename)
 
     if not os.path.exists(video_path):
         return {"error": "Video file not found"}
+    video_store.touch(video_path)
 
     return FileResponse(
         video_path,
-        media_type="video/mp4",
+        media_type=VIDEO_MEDIA_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream"),
         filename=filename,
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
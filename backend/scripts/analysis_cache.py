@@ -0,0 +1,155 @@
+import numpy as np
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+# Content addressed on-disk cache for audio analysis results.
+#
+# Entries are stored as .npy files named after a hash of the audio content and the
+# analysis parameters, so they survive restarts and can be memory mapped on a hit.
+# The modification time of an entry doubles as its last use, and the least recently
+# used entries are deleted when the cache grows beyond its byte limit.
+
+class AnalysisCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # (path, size, mtime) -> content hash, so unchanged files are only hashed once
+        self._file_hashes = {}
+
+    def get_key(self, audio_path, **params):
+        description = json.dumps({"audio": self.get_file_hash(audio_path), **params}, sort_keys=True)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get_file_hash(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        file_hash = self._file_hashes.get(file_id)
+        if file_hash is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            file_hash = digest.hexdigest()
+            self._file_hashes[file_id] = file_hash
+        return file_hash
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return array
+
+    def put(self, key, array):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        try:
+            os.replace(temp_path, path)
+        except PermissionError:
+            # Windows does not replace files that are memory mapped by another render
+            os.remove(temp_path)
+        self.evict()
+
+    def put_blocks(self, key, blocks):
+        # Writes an array that arrives in blocks along its first axis without holding it
+        # in memory. The rows go to a raw file first, because the .npy header needs the
+        # final shape. Returns the stored array memory mapped.
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._get_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        raw_path = f"{temp_path}.raw"
+        try:
+            rows = 0
+            dtype = np.dtype(np.float32)
+            row_shape = ()
+            with open(raw_path, "wb") as raw:
+                for block in blocks:
+                    block = np.ascontiguousarray(block)
+                    dtype = block.dtype
+                    row_shape = block.shape[1:]
+                    raw.write(block.tobytes())
+                    rows += len(block)
+
+            header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows, *row_shape)}
+            with open(temp_path, "wb") as f:
+                np.lib.format.write_array_header_1_0(f, header)
+                with open(raw_path, "rb") as raw:
+                    shutil.copyfileobj(raw, f, 1 << 20)
+            try:
+                os.replace(temp_path, path)
+            except PermissionError:
+                # Windows does not replace files that are memory mapped by another render
+                pass
+        finally:
+            for leftover in (raw_path, temp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self.evict()
+        return np.load(path, mmap_mode="r")
+
+    def evict(self):
+        entries = self._list_entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except (FileNotFoundError, PermissionError):
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        for path, _, _ in self._list_entries():
+            os.remove(path)
+
+    def stats(self):
+        entries = self._list_entries()
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def _list_entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
@@ -0,0 +1,439 @@
+from scripts.rendering import render_frames, prepare_render, polar_warp, get_canvas_size
+from scripts.streaming_analysis import iter_audio_blocks, iter_analysis_blocks, DECODE_BLOCK_SAMPLES
+from scripts.entrypoint import iter_frame_data, smooth_blocks, get_raw_video_input
+from scripts.outputs import X264_ARGS
+
+import numpy as np
+import soundfile as sf
+import cv2
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+
+# Benchmark of the render pipeline on synthetic audio.
+#
+# Every stage is timed on its own: decoding, the analysis (decoding and STFT), the
+# frame data (binning, normalization and smoothing), rendering for every style, polar
+# warp, anti-aliasing and encoding. Startup is timed in fresh interpreters: importing
+# the server and the modules a render worker needs, and starting a render pool until
+# every worker has rendered a frame. The peak memory of a stage is that of the timed
+# runs of the stage, or of the fresh interpreter for startup. Results are written as
+# JSON and can be compared against a saved baseline, which lists every case that got
+# slower than a threshold.
+#
+#   python -m scripts.benchmark --output results.json
+#   python -m scripts.benchmark --baseline baseline.json
+#   python -m scripts.benchmark --compare results.json baseline.json
+
+AUDIO_KINDS = ("sweep", "noise", "silence")
+STYLES = (
+    ("volume", None, None),
+    ("spectrum", "bar", "simple"),
+    ("spectrum", "bar", "lcd"),
+    ("spectrum", "point", "circle"),
+    ("spectrum", "point", "square"),
+    ("spectrum", "point", "donut"),
+    ("spectrum", "line", "simple"),
+    ("spectrum", "line", "filled"),
+)
+
+# Anti-aliasing modes that --anti-aliasing selects from
+ANTI_ALIASING = {
+    "off": {"antiAliasing": False},
+    "1x": {"antiAliasing": True, "antiAliasingMode": "supersample", "supersampling": 1},
+    "2x": {"antiAliasing": True, "antiAliasingMode": "supersample", "supersampling": 2},
+    "3x": {"antiAliasing": True, "antiAliasingMode": "supersample", "supersampling": 3},
+    "native": {"antiAliasing": True, "antiAliasingMode": "native"},
+}
+
+SAMPLE_RATE = 44100
+
+# Modules timed on import: the server, the render stages and a render worker
+STARTUP_MODULES = ("main", "scripts.entrypoint", "scripts.render_pool")
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+"""
+
+# Run with -c, spawned workers only import what the render tasks need
+POOL_SCRIPT = """
+import time
+start = time.perf_counter()
+from scripts.render_pool import RenderPool
+settings = {settings!r}
+pool = RenderPool(num_workers={workers})
+for _ in pool.render([[0.5] * settings["bins"]] * {workers}, settings):
+    pass
+seconds = time.perf_counter() - start
+pool.shutdown()
+"""
+
+# Appended to the scripts above, the peak is in kilobytes on Linux and bytes on macOS
+PEAK_RSS_SCRIPT = """
+try:
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:
+    peak_rss = -1
+print(seconds, peak_rss)
+"""
+
+BASE_SETTINGS = {
+    "visualization": "spectrum",
+    "style": "bar",
+    "styleVariant": "simple",
+    "fileName": "",
+    "width": 854,
+    "height": 480,
+    "framerate": 30,
+    "startEnd": [0, 10],
+    "smoothing": True,
+    "antiAliasing": True,
+    "polarWarp": False,
+    "bins": 64,
+    "binWidth": 0.5,
+    "lineThickness": 2,
+    "minMaxFrequency": [0, 4000],
+    "color": "#ffffff",
+    "backgroundColor": "#000000",
+    "innerOuterRadius": [0, 1],
+}
+
+# Frames rendered per batch, like a chunk of the render pool
+RENDER_BATCH_FRAMES = 16
+
+def run_benchmark(options):
+    results = []
+    workspace = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        if options.startup:
+            results += benchmark_startup(options)
+
+        for audio_kind in options.audio:
+            audio_path = os.path.join(workspace, f"{audio_kind}.wav")
+            sf.write(audio_path, generate_audio(audio_kind, options.seconds, SAMPLE_RATE), SAMPLE_RATE)
+            results += benchmark_audio(audio_path, audio_kind, options)
+
+        for width, height in options.resolutions:
+            results += benchmark_postprocessing(width, height, options)
+            results += benchmark_encode(width, height, workspace, options)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "seconds": options.seconds,
+        },
+        "results": results,
+    }
+
+def generate_audio(kind, seconds, sr):
+    t = np.arange(int(seconds * sr)) / sr
+    if kind == "sweep":
+        # Exponential sine sweep from 20 Hz to close to the Nyquist frequency
+        start_freq, end_freq = 20, sr / 2 * 0.9
+        rate = np.log(end_freq / start_freq)
+        y = 0.5 * np.sin(2 * np.pi * start_freq * seconds / rate * (np.exp(t / seconds * rate) - 1))
+    elif kind == "noise":
+        y = 0.25 * np.random.default_rng(0).standard_normal(len(t))
+    elif kind == "silence":
+        y = np.zeros(len(t))
+    else:
+        raise ValueError(f"Unknown audio kind: {kind}")
+    return y.astype(np.float32)
+
+def benchmark_startup(options):
+    # Best of several fresh interpreters, imports are only slow the first time
+    results = []
+    for module in STARTUP_MODULES:
+        seconds, peak_rss_mb = min(run_timed_script(IMPORT_SCRIPT.format(module=module)) for _ in range(options.repeat))
+        results.append(report("startup", {"import": module}, 1, seconds, peak_rss_mb))
+
+    workers = min(os.cpu_count() or 1, 4)
+    settings = dict(BASE_SETTINGS, width=options.resolutions[0][0], height=options.resolutions[0][1])
+    script = POOL_SCRIPT.format(settings=settings, workers=workers)
+    seconds, peak_rss_mb = min(run_timed_script(script) for _ in range(options.repeat))
+    results.append(report("startup", {"pool": workers}, 1, seconds, peak_rss_mb))
+    return results
+
+def run_timed_script(script):
+    # Seconds and peak memory the script prints as its last line
+    result = subprocess.run([sys.executable, "-c", script + PEAK_RSS_SCRIPT], cwd=BACKEND_DIR, capture_output=True, text=True, check=True)
+    seconds, peak_rss = result.stdout.split()[-2:]
+    peak_rss = int(peak_rss)
+    if peak_rss < 0:
+        return float(seconds), None
+    return float(seconds), peak_rss / 1024**2 if sys.platform == "darwin" else peak_rss / 1024
+
+def benchmark_audio(audio_path, audio_kind, options):
+    results = []
+    for framerate in options.framerates:
+        num_frames = int(options.seconds * framerate)
+        case = {"audio": audio_kind, "framerate": framerate}
+
+        seconds, peak_rss_mb = measure(lambda: consume(iter_audio_blocks(audio_path, 0, options.seconds, DECODE_BLOCK_SAMPLES)[1]), options.repeat)
+        results.append(report("decode", case, num_frames, seconds, peak_rss_mb))
+
+        for visualization in sorted({visualization for visualization, _, _ in options.styles}):
+            settings = dict(BASE_SETTINGS, visualization=visualization, framerate=framerate, startEnd=[0, options.seconds])
+            analysis = None
+
+            def analyze():
+                nonlocal analysis
+                sr, blocks = iter_analysis_blocks(audio_path, 0, options.seconds, settings)
+                analysis = np.concatenate(list(blocks))
+
+            # The first analysis imports SciPy, which startup times on its own
+            seconds, peak_rss_mb = measure(analyze, options.repeat, warm_up=True)
+            results.append(report("analysis", dict(case, visualization=visualization), num_frames, seconds, peak_rss_mb))
+
+            for bins in (options.bins if visualization == "spectrum" else [None]):
+                settings = dict(settings, bins=bins or BASE_SETTINGS["bins"])
+                frame_data = None
+
+                def get_frame_data():
+                    nonlocal frame_data
+                    frame_data = np.concatenate(list(smooth_blocks(iter_frame_data(analysis, SAMPLE_RATE, settings))))
+
+                seconds, peak_rss_mb = measure(get_frame_data, options.repeat, warm_up=True)
+                results.append(report("frame_data", dict(case, visualization=visualization, bins=bins), num_frames, seconds, peak_rss_mb))
+
+                # Rendering does not depend on the framerate
+                if framerate == options.framerates[0]:
+                    results += benchmark_render(frame_data[:options.render_frames], settings, audio_kind, options)
+    return results
+
+def benchmark_render(frame_data, settings, audio_kind, options):
+    results = []
+    for visualization, style, variant in options.styles:
+        if visualization != settings["visualization"]:
+            continue
+        for width, height in options.resolutions:
+            for anti_aliasing in options.anti_aliasing:
+                for polar in options.polar_warp:
+                    if visualization == "volume" and polar:
+                        continue
+                    render_settings = dict(
+                        settings,
+                        style=style or BASE_SETTINGS["style"],
+                        styleVariant=variant or BASE_SETTINGS["styleVariant"],
+                        width=width,
+                        height=height,
+                        polarWarp=polar,
+                        **ANTI_ALIASING[anti_aliasing],
+                    )
+                    prepare_render(render_settings)
+                    render_frames(frame_data[:1], render_settings)
+
+                    def render():
+                        for i in range(0, len(frame_data), RENDER_BATCH_FRAMES):
+                            render_frames(frame_data[i:i + RENDER_BATCH_FRAMES], render_settings)
+
+                    seconds, peak_rss_mb = measure(render, options.repeat)
+                    case = {
+                        "audio": audio_kind,
+                        "visualization": visualization,
+                        "style": style,
+                        "variant": variant,
+                        "bins": settings["bins"] if visualization == "spectrum" else None,
+                        "resolution": f"{width}x{height}",
+                        "antiAliasing": anti_aliasing,
+                        "polarWarp": polar,
+                    }
+                    results.append(report("render", case, len(frame_data), seconds, peak_rss_mb))
+    return results
+
+def benchmark_postprocessing(width, height, options):
+    # Polar warp and anti-aliasing on their own, on a canvas with random bars
+    results = []
+    settings = dict(BASE_SETTINGS, width=width, height=height, antiAliasing=True, polarWarp=True)
+    canvas_height, canvas_width = get_canvas_size(settings)
+    canvas = np.zeros((canvas_height, canvas_width, 3), dtype=np.uint8)
+    rows = np.random.default_rng(0).integers(0, canvas_height, canvas_width)
+    canvas[np.arange(canvas_height)[:, None] >= rows[None, :]] = 255
+    num_frames = options.render_frames
+
+    for interpolation in ("nearest", "bilinear"):
+        warp_settings = dict(settings, polarInterpolation=interpolation)
+        polar_warp(canvas, warp_settings)
+        seconds, peak_rss_mb = measure(lambda: [polar_warp(canvas, warp_settings) for _ in range(num_frames)], options.repeat)
+        results.append(report("polar_warp", {"resolution": f"{width}x{height}", "polarInterpolation": interpolation}, num_frames, seconds, peak_rss_mb))
+
+    seconds, peak_rss_mb = measure(lambda: [cv2.resize(canvas, (width, height)) for _ in range(num_frames)], options.repeat)
+    results.append(report("anti_aliasing", {"resolution": f"{width}x{height}"}, num_frames, seconds, peak_rss_mb))
+    return results
+
+def benchmark_encode(width, height, workspace, options):
+    if shutil.which("ffmpeg") is None:
+        print("encode: skipped, FFmpeg not found")
+        return []
+
+    framerate = options.framerates[0]
+    settings = dict(BASE_SETTINGS, width=width, height=height, framerate=framerate)
+    frame_data = np.random.default_rng(0).random((options.render_frames, settings["bins"]))
+    frames = b"".join(img.tobytes() for img in render_frames(frame_data, settings))
+    output_file = os.path.join(workspace, "encode.mp4")
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *get_raw_video_input(settings), *X264_ARGS, output_file]
+
+    # The peak is that of the benchmark process, FFmpeg runs in its own
+    seconds, peak_rss_mb = measure(lambda: subprocess.run(command, input=frames, check=True), options.repeat)
+    return [report("encode", {"resolution": f"{width}x{height}", "framerate": framerate}, options.render_frames, seconds, peak_rss_mb)]
+
+def measure(fn, repeat, warm_up=False):
+    # Best of several runs, the least disturbed one, and the peak memory of all runs.
+    # With warm_up, a first untimed run fills caches that a render only fills once.
+    if warm_up:
+        fn()
+    can_reset = reset_peak_rss()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, get_peak_rss_mb() if can_reset else None
+
+def consume(iterator):
+    for _ in iterator:
+        pass
+
+def report(stage, case, frames, seconds, peak_rss_mb=None):
+    result = {
+        "stage": stage,
+        "case": case,
+        "frames": frames,
+        "seconds": seconds,
+        "fps": frames / seconds if seconds > 0 else None,
+        "peak_rss_mb": peak_rss_mb,
+    }
+    description = ", ".join(f"{key}={value}" for key, value in case.items() if value is not None)
+    memory = f", peak {peak_rss_mb:.0f} MB" if peak_rss_mb is not None else ""
+    if stage == "startup":
+        # A single start, its time says more than its rate
+        print(f"{stage:<14} {description}: {seconds * 1000:.0f} ms{memory}")
+    else:
+        print(f"{stage:<14} {description}: {result['fps']:.1f} fps{memory}")
+    return result
+
+def reset_peak_rss():
+    # Only Linux can reset the peak memory of a process, elsewhere the peak would be that
+    # of the largest stage so far and is not reported. False if it cannot be reset.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+def get_peak_rss_mb():
+    # Peak since the last reset_peak_rss
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+def compare(results, baseline, threshold):
+    # Returns the cases that are slower than the baseline by more than the threshold
+    baseline_fps = {get_result_key(result): result["fps"] for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        previous = baseline_fps.get(get_result_key(result))
+        if not previous or not result["fps"]:
+            continue
+        change = result["fps"] / previous - 1
+        description = ", ".join(f"{key}={value}" for key, value in result["case"].items() if value is not None)
+        flag = ""
+        if change < -threshold:
+            regressions.append(result)
+            flag = "  REGRESSION"
+        if result["stage"] == "startup":
+            print(f"{result['stage']:<14} {description}: {1000 / previous:.0f} -> {1000 / result['fps']:.0f} ms ({change:+.1%}){flag}")
+        else:
+            print(f"{result['stage']:<14} {description}: {previous:.1f} -> {result['fps']:.1f} fps ({change:+.1%}){flag}")
+    return regressions
+
+def get_result_key(result):
+    return json.dumps([result["stage"], result["case"]], sort_keys=True)
+
+def parse_list(value, parse=str):
+    return [parse(item) for item in value.split(",") if item]
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def parse_style(value):
+    if value == "volume":
+        return ("volume", None, None)
+    style, variant = value.split("/")
+    return ("spectrum", style, variant)
+
+def parse_anti_aliasing(value):
+    # "on" is the default supersampling
+    value = {"on": "2x", "true": "2x", "false": "off"}.get(value, value)
+    if value not in ANTI_ALIASING:
+        raise argparse.ArgumentTypeError(f"unknown anti-aliasing mode: {value}")
+    return value
+
+def parse_switch(value):
+    return value in ("on", "true", "1")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the render pipeline on synthetic audio")
+    parser.add_argument("--audio", type=parse_list, default=list(AUDIO_KINDS), help="comma separated: sweep, noise, silence")
+    parser.add_argument("--seconds", type=float, default=10, help="length of the audio")
+    parser.add_argument("--resolutions", type=lambda value: parse_list(value, parse_resolution), default=[(854, 480), (1280, 720), (1920, 1080)])
+    parser.add_argument("--framerates", type=lambda value: parse_list(value, int), default=[30, 60])
+    parser.add_argument("--bins", type=lambda value: parse_list(value, int), default=[32, 128])
+    parser.add_argument("--styles", type=lambda value: parse_list(value, parse_style), default=list(STYLES), help="comma separated: volume, bar/simple, point/donut, ...")
+    parser.add_argument("--anti-aliasing", type=lambda value: parse_list(value, parse_anti_aliasing), default=["2x", "native"], help="comma separated: off, 1x, 2x, 3x, native")
+    parser.add_argument("--polar-warp", type=lambda value: parse_list(value, parse_switch), default=[False], help="comma separated: on, off")
+    parser.add_argument("--startup", type=parse_switch, default=True, help="time imports and pool startup: on, off")
+    parser.add_argument("--render-frames", type=int, default=60, help="frames rendered per render case")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest counts")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare the results against this file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown that counts as regression")
+    parser.add_argument("--compare", nargs=2, metavar=("RESULTS", "BASELINE"), help="compare two saved results without running")
+    options = parser.parse_args(argv)
+
+    if options.compare:
+        with open(options.compare[0]) as f:
+            results = json.load(f)
+        baseline_path = options.compare[1]
+    else:
+        results = run_benchmark(options)
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=2)
+        baseline_path = options.baseline
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.threshold)
+        print(f"{len(regressions)} regressions")
+        return 1 if regressions else 0
+    return 0
+
+# python -m scripts.benchmark
+if __name__ == "__main__":
+    sys.exit(main())
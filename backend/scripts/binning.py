@@ -0,0 +1,93 @@
+import numpy as np
+import functools
+
+# Frequency binning for the spectrum visualization as a single matrix product.
+#
+# The analysis holds the magnitudes of the STFT bins within the frequency range. A
+# (frequencies, bins) matrix maps them to the displayed bins: every display bin is the
+# mean of the STFT bins inside its frequency band, or a linear interpolation between the
+# two nearest STFT bins when its band is narrower than the FFT resolution. The matrix
+# only depends on the analysis parameters and is built once.
+
+BIN_SCALES = ("linear", "log", "mel")
+
+def bin_spectrum(filtered_magnitude, binning_matrix):
+    # (frames, frequencies) -> (frames, bins)
+    return filtered_magnitude @ binning_matrix
+
+def get_binning_matrix_for_settings(sr, settings):
+    min_freq, max_freq = settings["minMaxFrequency"]
+    return get_binning_matrix(
+        sr,
+        sr // settings["framerate"],
+        settings["bins"],
+        float(min_freq),
+        float(max_freq),
+        settings.get("binScale", "linear"),
+    )
+
+@functools.lru_cache(maxsize=32)
+def get_binning_matrix(sr, n_fft, bins, min_freq, max_freq, scale="linear"):
+    import librosa
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+    freqs = freqs[(freqs >= min_freq) & (freqs <= max_freq)]
+
+    if scale == "linear":
+        matrix = get_linear_matrix(len(freqs), bins)
+    elif scale in ("log", "mel"):
+        matrix = get_band_matrix(freqs, get_band_edges(freqs, bins, min_freq, max_freq, scale))
+    else:
+        raise ValueError(f"Unknown bin scale: {scale}")
+
+    matrix = matrix.astype(np.float32)
+    matrix.flags.writeable = False
+    return matrix
+
+def get_linear_matrix(num_freqs, bins):
+    matrix = np.zeros((num_freqs, bins))
+    if num_freqs < bins:
+        # Linear interpolation of the spectrum at evenly spaced positions
+        if num_freqs == 1:
+            matrix[0, :] = 1
+            return matrix
+        positions = np.linspace(0, num_freqs - 1, bins)
+        lower = np.minimum(np.floor(positions).astype(int), num_freqs - 2)
+        fraction = positions - lower
+        matrix[lower, np.arange(bins)] = 1 - fraction
+        matrix[lower + 1, np.arange(bins)] += fraction
+    else:
+        # Mean over evenly sized groups of neighbouring frequencies
+        bin_size = num_freqs / bins
+        for i in range(bins):
+            start, end = int(i * bin_size), int((i + 1) * bin_size)
+            matrix[start:end, i] = 1 / (end - start)
+    return matrix
+
+def get_band_edges(freqs, bins, min_freq, max_freq, scale):
+    if scale == "log":
+        # Logarithmic bands cannot start at 0 Hz, the lowest analyzed frequency above 0 is used instead
+        positive = freqs[freqs > 0]
+        low = max(min_freq, positive[0] if len(positive) else max_freq / 2 ** 10)
+        return np.geomspace(low, max_freq, bins + 1)
+    import librosa
+    mel_edges = np.linspace(librosa.hz_to_mel(min_freq), librosa.hz_to_mel(max_freq), bins + 1)
+    return librosa.mel_to_hz(mel_edges)
+
+def get_band_matrix(freqs, edges):
+    bins = len(edges) - 1
+    matrix = np.zeros((len(freqs), bins))
+    for i in range(bins):
+        low, high = edges[i], edges[i + 1]
+        in_band = (freqs >= low) & ((freqs < high) if i < bins - 1 else (freqs <= high))
+        if np.any(in_band):
+            matrix[in_band, i] = 1 / np.count_nonzero(in_band)
+        elif len(freqs) == 1:
+            matrix[0, i] = 1
+        else:
+            # Band narrower than the FFT resolution, interpolate at its center
+            center = (low + high) / 2
+            upper = int(np.clip(np.searchsorted(freqs, center), 1, len(freqs) - 1))
+            fraction = np.clip((center - freqs[upper - 1]) / (freqs[upper] - freqs[upper - 1]), 0, 1)
+            matrix[upper - 1, i] = 1 - fraction
+            matrix[upper, i] += fraction
+    return matrix
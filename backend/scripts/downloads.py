@@ -0,0 +1,184 @@
+from scripts.jobs import JobManager, check_cancelled
+
+import os
+import re
+import time
+import threading
+import collections
+import concurrent.futures
+
+# Metadata and audio of YouTube videos.
+#
+# Metadata is cached for a while, so a URL that is looked up again is not extracted
+# again, and lookups of a URL that is being extracted wait for that extraction. Every
+# video is downloaded by a single job: requests for a video that is being downloaded
+# get the job in flight. Downloads run in a small pool of their own, so they neither
+# block the server nor wait behind renders, and report their progress like renders.
+# The audio is written to a scratch directory and renamed into the upload store once
+# it is complete, so a half written track is never read. yt-dlp is only used through
+# the extractor, which a stub can replace to run without a network.
+
+METADATA_TTL = int(os.environ.get("YT_METADATA_TTL", 10 * 60))
+MAX_METADATA_ENTRIES = 256
+
+# Number of videos that are downloaded at the same time, further downloads wait
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 2))
+
+class YoutubeExtractor:
+    # yt-dlp is only imported once it is needed, it is slow to import and most renders do
+    # not use it
+    def extract_info(self, url):
+        import yt_dlp
+        with yt_dlp.YoutubeDL({"quiet": True, "extract_flat": True}) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    def download_audio(self, video_id, output_path, progress):
+        # Writes the audio of the video to output_path + ".mp3"
+        import yt_dlp
+
+        def on_download(status):
+            if status["status"] == "downloading":
+                progress("download", status.get("downloaded_bytes"), status.get("total_bytes") or status.get("total_bytes_estimate"))
+
+        def on_postprocess(status):
+            if status["status"] == "started":
+                progress("convert")
+
+        ydl_opts = {
+            "quiet": True,
+            "noprogress": True,
+            "format": "bestaudio/best",
+            "outtmpl": output_path,
+            "progress_hooks": [on_download],
+            "postprocessor_hooks": [on_postprocess],
+            "postprocessors": [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": "192",
+            }],
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([video_id])
+
+class DownloadManager:
+    def __init__(self, store, workspaces, extractor=None, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS, metadata_ttl=METADATA_TTL):
+        self.store = store
+        self.workspaces = workspaces
+        self.extractor = extractor or YoutubeExtractor()
+        self.metadata_ttl = metadata_ttl
+        self.jobs = JobManager(max_concurrent_jobs=max_concurrent_downloads, thread_name_prefix="download")
+        self.hits = 0
+        self.misses = 0
+        # URL -> (expiry time, future of the metadata), in the order they expire
+        self._metadata = collections.OrderedDict()
+        # Video ID -> job of its download
+        self._downloads = {}
+        self._lock = threading.Lock()
+
+    def get_metadata(self, url):
+        now = time.monotonic()
+        with self._lock:
+            self._forget_expired_metadata(now)
+            entry = self._metadata.get(url)
+            if entry is None:
+                self.misses += 1
+                future = concurrent.futures.Future()
+                self._metadata[url] = (now + self.metadata_ttl, future)
+                while len(self._metadata) > MAX_METADATA_ENTRIES:
+                    self._metadata.popitem(last=False)
+            else:
+                self.hits += 1
+                future = None
+
+        if future is None:
+            return dict(entry[1].result())
+
+        try:
+            metadata = get_video_metadata(self.extractor.extract_info(url))
+        except Exception as e:
+            # Failures are not cached, the next lookup tries again
+            with self._lock:
+                if url in self._metadata and self._metadata[url][1] is future:
+                    del self._metadata[url]
+            future.set_exception(e)
+            raise
+        future.set_result(metadata)
+        return dict(metadata)
+
+    def download(self, video_id):
+        # Job that downloads the audio of the video, the one in flight if there is one.
+        # None if the audio is already stored.
+        with self._lock:
+            job = self._downloads.get(video_id)
+            if job is not None and not job.is_finished():
+                return job
+            path = self.store.path(get_audio_filename(video_id))
+            if os.path.exists(path):
+                self.store.touch(path)
+                return None
+            for finished_id in [key for key, value in self._downloads.items() if value.is_finished()]:
+                del self._downloads[finished_id]
+            job = self.jobs.submit(self._download, video_id)
+            self._downloads[video_id] = job
+        return job
+
+    def get(self, download_id):
+        return self.jobs.get(download_id)
+
+    def cancel(self, download_id):
+        # Also cancels it for every other request that waits for it
+        return self.jobs.cancel(download_id)
+
+    def stats(self):
+        with self._lock:
+            metadata = {"hits": self.hits, "misses": self.misses, "entries": len(self._metadata)}
+        return {"metadata": metadata, "downloads": self.jobs.stats()}
+
+    def shutdown(self):
+        self.jobs.shutdown()
+
+    def _download(self, video_id, progress, cancel_event):
+        filename = get_audio_filename(video_id)
+
+        def report_progress(stage, current=None, total=None):
+            # Raising in a progress hook is the only way to stop yt-dlp
+            check_cancelled(cancel_event)
+            progress(stage, current, total)
+
+        with self.workspaces.create(prefix="download-") as workspace:
+            output_path = os.path.join(workspace, video_id)
+            try:
+                self.extractor.download_audio(video_id, output_path, report_progress)
+            except Exception:
+                # yt-dlp wraps the exceptions of its hooks
+                check_cancelled(cancel_event)
+                raise
+            path = self.store.path(filename)
+            with self.store.pin(path):
+                self.store.add(output_path + ".mp3", filename)
+        return filename
+
+    def _forget_expired_metadata(self, now):
+        while self._metadata:
+            url, (expires_at, future) = next(iter(self._metadata.items()))
+            if expires_at > now:
+                break
+            del self._metadata[url]
+
+def get_video_metadata(info_dict):
+    video = info_dict["entries"][0] if "entries" in info_dict else info_dict
+    return {
+        "title": video.get("title"),
+        "uploader": video.get("uploader"),
+        "duration": video.get("duration"),
+        "url": video.get("original_url"),
+        "thumbnail": video.get("thumbnail"),
+        "id": video.get("id"),
+    }
+
+def get_audio_filename(video_id):
+    return f"{video_id}.mp3"
+
+def is_video_id(value):
+    # Video IDs become filenames, so nothing that could leave the upload store is allowed
+    return isinstance(value, str) and re.fullmatch(r"[A-Za-z0-9_-]{1,64}", value) is not None
@@ -1,158 +1,399 @@
-from scripts.rendering import render_frame
+from scripts.jobs import check_cancelled
+from scripts.render_pool import RenderPool, get_segments, SEGMENTS_PER_WORKER
+from scripts.analysis_cache import AnalysisCache
+from scripts.workspace import FileStore, Workspaces
+from scripts.uploads import UploadIndex
+from scripts.metrics import span, tracing
+from scripts.outputs import get_profiles, get_output_filename, get_render_size, get_encode_command, get_mux_command, get_gif_command, get_audio_input, is_gif_profile
+from scripts.streaming_analysis import iter_analysis_blocks, get_band_weights, get_band_rms, BLOCK_FRAMES
+from scripts.binning import bin_spectrum, get_binning_matrix_for_settings
 
-import librosa
 import numpy as np
-import cv2
-from scipy.ndimage import convolve1d
-from scipy.interpolate import interp1d
 from pathvalidate import sanitize_filename, is_valid_filename
 
 import os
-import shutil
 import subprocess
+import contextlib
 import time
-import concurrent.futures
 
 import sys
 sys.stdout.reconfigure(encoding="utf-8")
 
-def get_video_file(audio_file_name, settings):
-    start_time = time.time()
-    start_time_sub = time.time()
+# Analysis results are kept on disk, so that re-rendering a track with a different
+# style skips decoding and the FFT
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", 2 * 1024**3))
+analysis_cache = AnalysisCache(os.path.abspath(os.path.join(os.path.dirname(__file__), "../cache/analysis")), ANALYSIS_CACHE_MAX_BYTES)
 
-    frames_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../frames"))
-    if os.path.exists(frames_path):
-        shutil.rmtree(frames_path)
+# Uploaded tracks and finished videos are deleted when their directory grows beyond its
+# quota or they have not been used for a while (in seconds)
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 2 * 1024**3))
+UPLOAD_MAX_AGE = int(os.environ.get("UPLOAD_MAX_AGE", 7 * 24 * 60 * 60))
+VIDEO_MAX_BYTES = int(os.environ.get("VIDEO_MAX_BYTES", 4 * 1024**3))
+VIDEO_MAX_AGE = int(os.environ.get("VIDEO_MAX_AGE", 24 * 60 * 60))
+upload_store = FileStore(os.path.abspath(os.path.join(os.path.dirname(__file__), "../upload")), UPLOAD_MAX_BYTES, UPLOAD_MAX_AGE)
+video_store = FileStore(os.path.abspath(os.path.join(os.path.dirname(__file__), "../video")), VIDEO_MAX_BYTES, VIDEO_MAX_AGE)
+upload_index = UploadIndex(upload_store, os.path.abspath(os.path.join(os.path.dirname(__file__), "../cache/uploads.json")))
+workspaces = Workspaces(os.path.abspath(os.path.join(os.path.dirname(__file__), "../workspace")))
 
-    base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../upload"))
-    audio_path = os.path.join(base_path, audio_file_name)
+SMOOTHING_KERNEL = np.array([0.25, 0.5, 0.25])
 
-    y, sr = load_audio(audio_path, settings['startEnd'][0], settings['startEnd'][1])
-    print_progress(start_time_sub, time.time(), "Loading Audio")
+# Keyframe interval of segmented renders, segments always contain whole GOPs
+GOP_SECONDS = 2
 
-    start_time_sub = time.time()
-    frame_data = get_frame_data(y, sr, settings)
-    if (settings['smoothing']):
-        kernel = np.array([0.25, 0.5, 0.25])
-        frame_data = convolve1d(frame_data, kernel, axis=0, mode='nearest')
-    print_progress(start_time_sub, time.time(), "Calculating Data")
+# If set, a trace of the stages of every render is saved in this directory
+TRACE_DIR = os.environ.get("TRACE_DIR")
 
-    start_time_sub = time.time()
-    output_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../frames"))
-    os.makedirs(output_dir, exist_ok=True)
+def get_video_file(audio_file_name, settings, save_frames=False, progress=None, cancel_event=None, render_pool=None, segmented=None):
+    # Renders a single MP4 and returns its file name
+    return get_video_files(audio_file_name, settings, None, save_frames, progress, cancel_event, render_pool, segmented)[0]
 
-    MAX_CORES = 8
-    num_workers = os.cpu_count() if os.cpu_count() and os.cpu_count() < MAX_CORES else MAX_CORES
-    args_list = [(i, data, settings, output_dir) for i, data in enumerate(frame_data)]
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        executor.map(render_and_save_frame, args_list)
-    print_progress(start_time_sub, time.time(), "Saving Frames")
+def get_video_files(audio_file_name, settings, outputs=None, save_frames=False, progress=None, cancel_event=None, render_pool=None, segmented=None):
+    # Renders the visualization once and returns the file names of all outputs
+    start_time = time.time()
+    profiles = get_profiles(settings, outputs)
+
+    audio_path = upload_store.path(upload_index.resolve(audio_file_name))
 
-    start_time_sub = time.time()
-    os.makedirs(os.path.abspath(os.path.join(os.path.dirname(__file__), "../video")), exist_ok=True)
     filename = settings['fileName'] if settings['fileName'] else "video"
     if not is_valid_filename(filename):
         filename = sanitize_filename(filename)
-    output_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "../video/" + filename + ".mp4"))
+    filenames = [get_output_filename(filename, profile) for profile in profiles]
+
+    # The track cannot be evicted while it is rendered, and all intermediate files of the
+    # render stay in its own workspace
+    with trace_render(filename), span("total"), upload_store.pin(audio_path), workspaces.create() as workspace:
+        # The videos are only moved to video/ once they are all complete
+        work_files = [os.path.join(workspace, name) for name in filenames]
+        render_video(audio_path, settings, profiles, work_files, workspace, save_frames, progress, cancel_event, render_pool, segmented)
+        with contextlib.ExitStack() as pins:
+            # Adding a video must not evict the ones added before it
+            for name in filenames:
+                pins.enter_context(video_store.pin(video_store.path(name)))
+            for work_file, name in zip(work_files, filenames):
+                video_store.add(work_file, name)
+        print(f"Video saved as: {', '.join(filenames)}")
+
+    print_progress(start_time, time.time(), "Total")
+    return filenames
+
+def trace_render(filename):
+    if not TRACE_DIR:
+        return contextlib.nullcontext()
+    path = os.path.join(TRACE_DIR, f"{filename}-{int(time.time() * 1000)}.json")
+    print(f"Tracing render to: {path}")
+    return tracing(path)
+
+def render_video(audio_path, settings, profiles, output_files, workspace, save_frames=False, progress=None, cancel_event=None, render_pool=None, segmented=None):
+    # Frames reach FFmpeg in one of three ways:
+    #   - save_frames: every frame is saved as a PNG and encoded afterwards, for debugging
+    #   - segmented: workers render and encode GOP aligned segments in parallel, which
+    #     are joined afterwards. The default with more than one render worker.
+    #   - streamed: the frames are piped as raw video into a single FFmpeg process. The
+    #     default with a single render worker (RENDER_WORKERS=1), or with segmented=False.
+    # tests/test_render_video.py renders through the streamed path with both.
+    analysis = get_cached_analysis(audio_path, settings, progress, cancel_event)
+
+    # The frames are rendered once at the size of the largest video, which FFmpeg scales
+    # to every other video. GIFs are cut from the finished video afterwards.
+    videos = [(profile, output_file) for profile, output_file in zip(profiles, output_files) if not is_gif_profile(profile)]
+    gifs = [(profile, output_file) for profile, output_file in zip(profiles, output_files) if is_gif_profile(profile)]
+    video_profiles = [profile for profile, _ in videos]
+    video_files = [output_file for _, output_file in videos]
+    render_size = get_render_size(settings, video_profiles)
+    settings = dict(settings, width=render_size[0], height=render_size[1])
+    audio_input = get_audio_input(audio_path, *settings['startEnd'])
+    audio_codec = upload_index.get_codec(audio_path)
 
-    ffmpeg_command = [
-        "ffmpeg",
-        "-hide_banner",
-        "-loglevel", "error",
-        "-y",
+    check_cancelled(cancel_event)
+    # Frame data is produced block by block while rendering, so it never has to be held
+    # in memory as a whole
+    num_frames = len(analysis)
+    frame_blocks = iter_frame_data(analysis, upload_index.get_sample_rate(audio_path), settings)
+    if (settings['smoothing']):
+        frame_blocks = smooth_blocks(frame_blocks)
+    frame_data = (data for block in frame_blocks for data in block)
+
+    # Renders outside of the server (e.g. from __main__) get a pool of their own
+    own_pool = render_pool is None
+    if own_pool:
+        render_pool = RenderPool()
+    # Splitting the video only pays off if segments can be encoded side by side
+    if segmented is None:
+        segmented = render_pool.num_workers > 1
+
+    try:
+        start_time_sub = time.time()
+        if save_frames:
+            # Debug fallback: render every frame to a PNG and encode them afterwards
+            frames_path = os.path.join(workspace, "frames")
+            os.makedirs(frames_path)
+            rendered = 0
+            for chunk_frames, _ in render_pool.render(frame_data, settings, output_dir=frames_path, cancel_event=cancel_event):
+                rendered += chunk_frames
+                report_progress(progress, "render", rendered, num_frames)
+            print_progress(start_time_sub, time.time(), "Saving Frames")
+
+            start_time_sub = time.time()
+            report_progress(progress, "encode")
+            video_input = ["-framerate", str(settings['framerate']), "-i", os.path.join(frames_path, "%05d.png")]
+            command = get_encode_command(video_input, video_profiles, render_size, settings['backgroundColor'], video_files, audio_input, audio_codec)
+            with span("ffmpeg"):
+                returncode = subprocess.run(command).returncode
+            message = "FFMPEG"
+        elif segmented:
+            returncode = render_segmented(frame_blocks, num_frames, settings, video_profiles, video_files, audio_input, audio_codec, workspace, render_pool, progress, cancel_event)
+            message = "Rendering and Encoding Segments"
+        else:
+            command = get_encode_command(get_raw_video_input(settings), video_profiles, render_size, settings['backgroundColor'], video_files, audio_input, audio_codec)
+            returncode = stream_frames_to_ffmpeg(frame_data, num_frames, settings, command, render_pool, progress, cancel_event)
+            message = "Rendering and Encoding"
+    finally:
+        if own_pool:
+            render_pool.shutdown()
+
+    if returncode != 0:
+        raise RuntimeError(f"FFmpeg failed with exit code {returncode}")
+
+    if gifs:
+        source_profile, source_file = max(videos, key=lambda video: video[0]["width"] * video[0]["height"])
+        for profile, output_file in gifs:
+            check_cancelled(cancel_event)
+            command = get_gif_command(source_file, (source_profile["width"], source_profile["height"]), profile, settings['backgroundColor'], output_file)
+            with span("ffmpeg"):
+                returncode = subprocess.run(command).returncode
+            if returncode != 0:
+                raise RuntimeError(f"FFmpeg failed with exit code {returncode}")
+    print_progress(start_time_sub, time.time(), message)
+
+def get_raw_video_input(settings):
+    return [
+        "-f", "rawvideo",
+        "-pix_fmt", "bgr24",
+        "-s", f"{settings['width']}x{settings['height']}",
         "-framerate", str(settings['framerate']),
-        "-i", os.path.join(output_dir, "%05d.png"),
-        "-i", audio_path,
-        "-c:v", "libx264",
-        "-pix_fmt", "yuv420p",
-        "-c:a", "libmp3lame",
-        "-b:a", "192k",
-        "-map", "0:v:0",
-        "-map", "1:a:0",
-        "-shortest",
-        output_file
+        "-i", "-",
     ]
 
-    try:
-        subprocess.run(ffmpeg_command, check=True)
-        print_progress(start_time_sub, time.time(), "FFMPEG")
-        print(f"Video saved as: {filename}")
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg failed: {e}")
+def render_segmented(frame_blocks, num_frames, settings, profiles, output_files, audio_input, audio_codec, workspace, render_pool, progress=None, cancel_event=None):
+    # The frame data goes to a scratch file that the workers read their segments from.
+    # Every segment is encoded to every profile on its own, the concat demuxer joins the
+    # segments of a profile without encoding again and the audio is added in the same pass.
+    frames_path = os.path.join(workspace, "frames.npy")
+    save_frame_blocks(frame_blocks, num_frames, frames_path, cancel_event)
 
-    print_progress(start_time, time.time(), "Total")
-    return filename + ".mp4"
+    gop_frames = settings['framerate'] * GOP_SECONDS
+    segments = [
+        (start, end, tuple(os.path.join(workspace, f"segment_{i:05d}_{j}.{profile['container']}") for j, profile in enumerate(profiles)))
+        for i, (start, end) in enumerate(get_segments(num_frames, gop_frames, render_pool.num_workers * SEGMENTS_PER_WORKER))
+    ]
+    render_size = (settings['width'], settings['height'])
+    encode_command = get_encode_command(get_raw_video_input(settings), profiles, render_size, settings['backgroundColor'], [None] * len(profiles), gop_frames=gop_frames)
+    rendered = 0
+    for segment_frames in render_pool.render_segments(frames_path, segments, settings, encode_command, cancel_event):
+        rendered += segment_frames
+        report_progress(progress, "render", rendered, num_frames)
 
-def get_preview_image(settings):
-    frame_data = []
-    if (settings["visualization"] == "volume"):
-        frame_data = [1]
-    elif (settings["visualization"] == "spectrum"):
-        sample_data = np.load(os.path.join(os.path.abspath(os.path.dirname(__file__)), "_sample_audio.npz"))
-        frame_data = get_frame_data(sample_data["y"], sample_data["sr"], settings)
-    img = render_frame(frame_data[0], settings)
-    output_dir = os.path.abspath(os.path.dirname(__file__))
-    filename = os.path.join(output_dir, "_preview.jpg")
-    cv2.imwrite(filename, img)
-    return "_preview.jpg"
+    report_progress(progress, "encode")
+    for j, (profile, output_file) in enumerate(zip(profiles, output_files)):
+        list_path = os.path.join(workspace, f"segments_{j}.txt")
+        with open(list_path, "w") as f:
+            for _, _, segment_files in segments:
+                f.write(f"file '{os.path.basename(segment_files[j])}'\n")
+        command = get_mux_command(["-f", "concat", "-i", list_path], profile, audio_input, audio_codec, output_file)
+        with span("ffmpeg"):
+            returncode = subprocess.run(command).returncode
+        if returncode != 0:
+            return returncode
+    return 0
+
+def save_frame_blocks(frame_blocks, num_frames, path, cancel_event=None):
+    frame_data = None
+    position = 0
+    for block in frame_blocks:
+        check_cancelled(cancel_event)
+        if frame_data is None:
+            frame_data = np.lib.format.open_memmap(path, mode="w+", dtype=block.dtype, shape=(num_frames, *block.shape[1:]))
+        frame_data[position:position + len(block)] = block
+        position += len(block)
+    if frame_data is not None:
+        frame_data.flush()
+        del frame_data
+
+def stream_frames_to_ffmpeg(frame_data, total, settings, ffmpeg_command, render_pool, progress=None, cancel_event=None):
+    # The pool renders chunks of frames in parallel and hands them back in order, so
+    # they can be written to FFmpeg as they come
+    process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+    try:
+        written = 0
+        for chunk_frames, buffer in render_pool.render(frame_data, settings, cancel_event=cancel_event):
+            with span("write"):
+                process.stdin.write(buffer)
+            written += chunk_frames
+            report_progress(progress, "render", written, total)
+        report_progress(progress, "encode")
+        process.stdin.close()
+    except BrokenPipeError:
+        # FFmpeg exited early, its exit code tells what went wrong
+        pass
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    # What FFmpeg still has to encode after the last frame
+    with span("ffmpeg"):
+        return process.wait()
 
 def print_progress(start, end, message):
     print(f"{message}: {end - start:.2f} seconds")
 
+def report_progress(progress, stage, current=None, total=None):
+    if progress is not None:
+        progress(stage, current, total)
+
+def get_analysis_key(audio_path, settings):
+    return analysis_cache.get_key(
+        audio_path,
+        sr=None,
+        visualization=settings["visualization"],
+        framerate=settings["framerate"],
+        startEnd=settings["startEnd"],
+        minMaxFrequency=settings["minMaxFrequency"],
+        version=2,
+    )
+
+def get_cached_analysis(audio_path, settings, progress=None, cancel_event=None):
+    with span("load"):
+        key = get_analysis_key(audio_path, settings)
+        analysis = analysis_cache.get(key)
+    if analysis is not None:
+        print("Using cached analysis")
+        return analysis
+
+    start_time_sub = time.time()
+    report_progress(progress, "decode")
+    sr, blocks = iter_analysis_blocks(audio_path, settings['startEnd'][0], settings['startEnd'][1], settings)
+
+    def checked_blocks():
+        analyzed = 0
+        for block in blocks:
+            check_cancelled(cancel_event)
+            analyzed += len(block)
+            report_progress(progress, "analysis", analyzed)
+            yield block
+
+    # Decoding is streamed, so it is part of the analysis span
+    with span("analysis"):
+        analysis = analysis_cache.put_blocks(key, checked_blocks())
+    print_progress(start_time_sub, time.time(), "Loading and Analyzing Audio")
+    return analysis
+
 def load_audio(file_path, start, end):
     # audio_sample, sr = librosa.load(file_path, sr=None)
     # np.savez("_sample_audio.npz", y=y, sr=sr)
+    import librosa
     return librosa.load(file_path, sr=None, offset=start, duration=end - start)
 
 def get_frame_data(y, sr, settings):
+    return get_frame_data_from_analysis(get_analysis(y, sr, settings), sr, settings)
+
+def get_analysis(y, sr, settings):
+    # The expensive, style independent part of get_frame_data with one row per frame:
+    # the RMS within the frequency range for volume and the magnitude spectrum within
+    # the frequency range for spectrum. iter_analysis_blocks computes the same from a
+    # file in blocks.
+    import librosa
     samples_per_frame = sr // settings["framerate"]
     if (settings["visualization"] == "volume"):
         stft = librosa.stft(y, n_fft=samples_per_frame, hop_length=samples_per_frame)
+        band_weights = get_band_weights(sr, samples_per_frame, [settings["minMaxFrequency"]])
+        return get_band_rms(np.abs(stft).T, band_weights)[:, 0]
+
+    elif settings["visualization"] == "spectrum":
+        stft = librosa.stft(y, n_fft=samples_per_frame, hop_length=samples_per_frame)
+        magnitude = np.abs(stft)
         freqs = librosa.fft_frequencies(sr=sr, n_fft=samples_per_frame)
 
         min_freq, max_freq = settings["minMaxFrequency"]
         valid_indices = np.where((freqs >= min_freq) & (freqs <= max_freq))[0]
+        return magnitude[valid_indices, :].T
 
-        filtered_stft = np.zeros_like(stft)
-        filtered_stft[valid_indices, :] = stft[valid_indices, :]
-        filtered_y = librosa.istft(filtered_stft, hop_length=samples_per_frame)
+def get_frame_data_from_analysis(analysis, sr, settings):
+    return np.concatenate(list(iter_frame_data(analysis, sr, settings)))
 
-        rms = librosa.feature.rms(y=filtered_y, frame_length=samples_per_frame, hop_length=samples_per_frame)
-        db = librosa.amplitude_to_db(rms, ref=np.max)
-        normalized_db = np.clip((db[0] + 60) / 60, 0, 1)
-        return normalized_db
+def iter_frame_data(analysis, sr, settings, block_frames=BLOCK_FRAMES):
+    with span("normalize"):
+        reference = get_frame_reference(analysis, sr, settings, block_frames)
+    for i in range(0, max(len(analysis), 1), block_frames):
+        with span("normalize"):
+            block = normalize_frames(analysis[i:i + block_frames], sr, settings, reference)
+        yield block
+
+def get_frame_reference(analysis, sr, settings, block_frames=BLOCK_FRAMES):
+    # Normalization needs the global maximum, which a first pass over the analysis finds
+    # before the normalized blocks are produced
+    if (settings["visualization"] == "volume"):
+        return np.max(analysis)
 
     elif settings["visualization"] == "spectrum":
-        stft = librosa.stft(y, n_fft=samples_per_frame, hop_length=samples_per_frame)
-        magnitude = np.abs(stft)
-        freqs = librosa.fft_frequencies(sr=sr, n_fft=samples_per_frame)
+        binning_matrix = get_binning_matrix_for_settings(sr, settings)
+        return max(
+            np.max(bin_spectrum(analysis[i:i + block_frames], binning_matrix))
+            for i in range(0, max(len(analysis), 1), block_frames)
+        )
 
-        min_freq, max_freq = settings["minMaxFrequency"]
-        valid_indices = np.where((freqs >= min_freq) & (freqs <= max_freq))[0]
-        filtered_magnitude = magnitude[valid_indices, :]
+def normalize_frames(analysis_rows, sr, settings, reference):
+    if (settings["visualization"] == "volume"):
+        import librosa
+        db = librosa.amplitude_to_db(np.asarray(analysis_rows), ref=reference)
+        return np.clip((db + 60) / 60, 0, 1)
+
+    elif settings["visualization"] == "spectrum":
+        binned_spectrum = bin_spectrum(analysis_rows, get_binning_matrix_for_settings(sr, settings))
+        if reference <= 0:
+            # Silence, there is nothing to normalize to
+            return np.zeros_like(binned_spectrum)
+        return np.clip(binned_spectrum / reference, 0, 1)
 
-        bins = settings["bins"]
+def get_frame_data_at(analysis, sr, settings, frame_index, reference):
+    # A single frame as it appears in the video
+    return get_frame_data_range(analysis, sr, settings, frame_index, frame_index + 1, reference)[0]
 
-        if len(valid_indices) < bins:
-            x_old = np.linspace(0, 1, len(valid_indices))
-            x_new = np.linspace(0, 1, bins)
-            interpolator = interp1d(x_old, filtered_magnitude, axis=0, kind="linear", fill_value="extrapolate")
-            binned_spectrum = interpolator(x_new)
-        else:
-            bin_size = max(1, len(valid_indices) / bins)
-            binned_spectrum = np.array([
-                np.mean(filtered_magnitude[int(i * bin_size) : int((i + 1) * bin_size)], axis=0)
-                for i in range(bins)
-            ])
-
-        normalized_spectrum = np.clip(binned_spectrum / np.max(binned_spectrum), 0, 1)
-        return normalized_spectrum.T
-
-def render_and_save_frame(args):
-    i, data, settings, output_dir = args
-    img = render_frame(data, settings)
-    filename = os.path.join(output_dir, f"{i:05d}.png")
-    cv2.imwrite(filename, img)
+def get_frame_data_range(analysis, sr, settings, start, end, reference):
+    # Frames start to end as they appear in the video, smoothing only needs the frames
+    # next to them
+    padded_start = max(start - 1, 0)
+    frames = normalize_frames(analysis[padded_start:end + 1], sr, settings, reference)
+    if (settings['smoothing']):
+        frames = smooth_block(frames, None, None, SMOOTHING_KERNEL)
+    return frames[start - padded_start:end - padded_start]
+
+def smooth_blocks(blocks):
+    # Same as smoothing the whole frame data at once, every block borrows the
+    # neighbouring frames of the blocks before and after it
+    kernel = SMOOTHING_KERNEL
+    previous_last = None
+    current = None
+    for block in blocks:
+        if current is not None:
+            with span("smoothing"):
+                smoothed = smooth_block(current, previous_last, block[:1], kernel)
+            yield smoothed
+            previous_last = current[-1:]
+        current = block
+    if current is not None:
+        with span("smoothing"):
+            smoothed = smooth_block(current, previous_last, None, kernel)
+        yield smoothed
+
+def smooth_block(block, before, after, kernel):
+    # Imported on first use, so that starting the server does not wait for SciPy
+    from scipy.ndimage import convolve1d
+    padded = np.concatenate([
+        before if before is not None else block[:1],
+        block,
+        after if after is not None else block[-1:],
+    ])
+    return convolve1d(padded, kernel, axis=0, mode='nearest')[1:-1]
 
 
 # python -m scripts.entrypoint
@@ -0,0 +1,210 @@
+from scripts.metrics import Counter
+
+import concurrent.futures
+import threading
+import time
+import uuid
+
+# Background render jobs. A job runs a blocking function in a thread pool, so that the
+# event loop of the server stays responsive, and collects the progress the function
+# reports. The function receives a progress callback and a cancel event as keyword
+# arguments and should call check_cancelled(cancel_event) between its stages.
+#
+# A job that may be tried more than once goes back to the end of the queue when it
+# fails, so the jobs behind it are not held up. A batch groups the jobs of one request
+# and reports the status of every job.
+
+FINISHED_STATES = ("done", "failed", "cancelled")
+
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION = 60 * 60
+
+JOB_RETRIES = Counter("visualizer_job_retries_total", "Failed jobs put back in the queue")
+
+class JobCancelled(Exception):
+    pass
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled()
+
+class Job:
+    def __init__(self, job_id, max_attempts=1):
+        self.id = job_id
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self.status = "queued"
+        self.stage = None
+        self.current = None
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        # Increased on every change, so that listeners can tell if there is something new
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def update(self, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            if self.status in FINISHED_STATES and self.finished_at is None:
+                self.finished_at = time.time()
+            self.version += 1
+
+    def report_progress(self, stage, current=None, total=None):
+        self.update(stage=stage, current=current, total=total)
+
+    def is_finished(self):
+        return self.status in FINISHED_STATES
+
+    def snapshot(self):
+        with self._lock:
+            return self.version, {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "current": self.current,
+                "total": self.total,
+                "result": self.result,
+                "error": self.error,
+                "attempts": self.attempts,
+            }
+
+class Batch:
+    def __init__(self, batch_id, jobs):
+        self.id = batch_id
+        self.jobs = jobs
+        self.created_at = time.time()
+
+    def is_finished(self):
+        return all(job.is_finished() for job in self.jobs)
+
+    def finished_at(self):
+        if not self.is_finished():
+            return None
+        return max((job.finished_at or self.created_at for job in self.jobs), default=self.created_at)
+
+    def snapshot(self, get_job_state=None):
+        # get_job_state(job) can add to the state of every job, e.g. URLs of the results
+        items = [get_job_state(job) if get_job_state else job.snapshot()[1] for job in self.jobs]
+        counts = dict.fromkeys(("queued", "running", *FINISHED_STATES), 0)
+        for item in items:
+            counts[item["status"]] += 1
+        return {"batch_id": self.id, "status": get_batch_status(counts), "counts": counts, "items": items}
+
+def get_batch_status(counts):
+    if counts["queued"] + counts["running"] > 0:
+        return "running" if counts["running"] + counts["done"] + counts["failed"] > 0 else "queued"
+    if counts["failed"] > 0:
+        return "failed"
+    if counts["done"] > 0:
+        return "done"
+    return "cancelled"
+
+class JobManager:
+    def __init__(self, max_concurrent_jobs=1, thread_name_prefix="render-job"):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix=thread_name_prefix)
+        self.jobs = {}
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, max_attempts=1, **kwargs):
+        job = Job(uuid.uuid4().hex, max_attempts)
+        with self._lock:
+            self._forget_old_jobs()
+            self.jobs[job.id] = job
+        job.future = self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def submit_batch(self, fn, items, max_attempts=1):
+        # Submits a job for every tuple of arguments in items, in order
+        jobs = [self.submit(fn, *args, max_attempts=max_attempts) for args in items]
+        batch = Batch(uuid.uuid4().hex, jobs)
+        with self._lock:
+            self.batches[batch.id] = batch
+        return batch
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self.batches.get(batch_id)
+
+    def cancel_batch(self, batch_id):
+        batch = self.get_batch(batch_id)
+        if batch is None:
+            return None
+        # Later jobs first, so that none of them starts while the earlier ones are cancelled
+        for job in reversed(batch.jobs):
+            self.cancel(job.id)
+        return batch
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        # Jobs that have not started yet never reach _run
+        if job.future is not None and job.future.cancel():
+            job.update(status="cancelled")
+        return job
+
+    def stats(self):
+        # Number of known jobs per status, queued jobs are the length of the queue
+        counts = dict.fromkeys(("queued", "running", *FINISHED_STATES), 0)
+        with self._lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel_event.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_event.is_set():
+            job.update(status="cancelled")
+            return
+        job.update(status="running", attempts=job.attempts + 1)
+        try:
+            result = fn(*args, progress=job.report_progress, cancel_event=job.cancel_event, **kwargs)
+        except JobCancelled:
+            job.update(status="cancelled")
+        except Exception as e:
+            if job.attempts < job.max_attempts and not job.cancel_event.is_set():
+                # Queued before it is submitted again, so that the next attempt cannot start first
+                job.update(status="queued", stage=None, current=None, total=None, error=str(e))
+                if self._requeue(job, fn, args, kwargs):
+                    print(f"Job {job.id} failed ({e!r}), trying again")
+                    JOB_RETRIES.inc()
+                    return
+            job.update(status="failed", error=str(e))
+        else:
+            job.update(status="done", result=result, error=None)
+
+    def _requeue(self, job, fn, args, kwargs):
+        # False if the manager is shutting down
+        try:
+            job.future = self.executor.submit(self._run, job, fn, args, kwargs)
+        except RuntimeError:
+            return False
+        return True
+
+    def _forget_old_jobs(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > JOB_RETENTION:
+                del self.jobs[job_id]
+        for batch_id, batch in list(self.batches.items()):
+            finished_at = batch.finished_at()
+            if finished_at is not None and now - finished_at > JOB_RETENTION:
+                del self.batches[batch_id]
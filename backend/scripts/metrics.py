@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import contextvars
+import collections
+
+# Lightweight instrumentation, exported in the Prometheus text format.
+#
+# The stages of a render are timed with spans, which are observed in a histogram per
+# stage and, if the render is traced, kept as events of its trace. Render workers time
+# their chunks themselves and send the spans back with their results, where they are
+# merged into the metrics of the server. Values that are already counted elsewhere
+# (cache hits, queued jobs) are read by collectors when the metrics are scraped.
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+FRAME_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+_metrics = []
+_collectors = []
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = get_label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(get_label_values(self.label_names, labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        if not self.label_names and not values:
+            values[()] = 0
+        samples = [(dict(zip(self.label_names, key)), value) for key, value in values.items()]
+        return render_metric(self.name, "counter", self.documentation, samples)
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # Label values -> (count per bucket and above the last one, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, count=1, **labels):
+        # count observations of the same value at once, e.g. for every frame of a chunk
+        key = get_label_values(self.label_names, labels)
+        bucket = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            bucket_counts, total, observations = self._values.get(key, ([0] * (len(self.buckets) + 1), 0, 0))
+            bucket_counts[bucket] += count
+            self._values[key] = (bucket_counts, total + value * count, observations + count)
+
+    def get(self, **labels):
+        # Sum and count of the observations
+        with self._lock:
+            _, total, observations = self._values.get(get_label_values(self.label_names, labels), (None, 0, 0))
+            return total, observations
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(bucket_counts), total, observations) for key, (bucket_counts, total, observations) in self._values.items()}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, observations) in values.items():
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), bucket_counts):
+                cumulative += bucket_count
+                lines.append(render_sample(f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative))
+            lines.append(render_sample(f"{self.name}_sum", labels, total))
+            lines.append(render_sample(f"{self.name}_count", labels, observations))
+        return "\n".join(lines)
+
+class Trace:
+    # Spans of a single render in the Trace Event Format, which chrome://tracing and
+    # Perfetto open
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, end, pid=None, tid=None, args=None):
+        event = {
+            "name": stage,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": pid if pid is not None else os.getpid(),
+            "tid": tid if tid is not None else threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def dump(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+STAGE_SECONDS = Histogram("visualizer_stage_seconds", "Time spent in a stage of a render", ("stage",))
+FRAME_RENDER_SECONDS = Histogram("visualizer_frame_render_seconds", "Time the render workers take per frame", buckets=FRAME_BUCKETS)
+FRAMES_RENDERED = Counter("visualizer_frames_rendered_total", "Frames rendered by the render workers")
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(stage, start, time.time())
+
+def record_span(stage, start, end, pid=None, tid=None, args=None):
+    STAGE_SECONDS.observe(end - start, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, start, end, pid, tid, args)
+
+def record_worker_spans(spans):
+    # Spans a render worker sent back: (stage, start, end, pid, frames), frames is the
+    # number of frames rendered in the span or None
+    for stage, start, end, pid, frames in spans:
+        record_span(stage, start, end, pid=pid, tid=0, args={"frames": frames} if frames else None)
+        if frames:
+            FRAME_RENDER_SECONDS.observe((end - start) / frames, count=frames)
+            FRAMES_RENDERED.inc(frames)
+
+@contextlib.contextmanager
+def tracing(path):
+    # Keeps the spans of the code within (and of the workers it waits for) in a trace
+    # that is written to path at the end
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.dump(path)
+
+def register_collector(collector):
+    # collector() returns (name, type, documentation, [(labels, value), ...]) tuples of
+    # values that are read at every scrape
+    _collectors.append(collector)
+
+def render_metrics():
+    parts = [metric.render() for metric in _metrics]
+    for collector in _collectors:
+        for name, metric_type, documentation, samples in collector():
+            parts.append(render_metric(name, metric_type, documentation, samples))
+    return "\n".join(parts) + "\n"
+
+def render_metric(name, metric_type, documentation, samples):
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    lines.extend(render_sample(name, labels, value) for labels, value in samples)
+    return "\n".join(lines)
+
+def render_sample(name, labels, value):
+    if labels:
+        label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+        return f"{name}{{{label_text}}} {float(value)!r}"
+    return f"{name} {float(value)!r}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def get_label_values(label_names, labels):
+    return tuple(str(labels[name]) for name in label_names)
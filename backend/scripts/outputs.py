@@ -0,0 +1,215 @@
+from scripts.rendering import hex_to_bgr
+
+from pathvalidate import sanitize_filename
+
+# Output profiles of a render.
+#
+# A render can produce several videos of the same visualization, e.g. 1080p, 720p and a
+# square cut. The frames are rendered once, large enough for the largest output, and a
+# single FFmpeg process splits them into a scale (and crop or pad) chain and an encoder
+# per output. GIF previews are cut from the finished video afterwards, because their
+# palette needs all of their frames before the first one can be written. The audio is
+# read only within startEnd and copied if the container can hold its codec.
+
+FFMPEG = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+
+X264_ARGS = ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+
+VIDEO_CODECS = {
+    "h264": X264_ARGS,
+    "h265": ["-c:v", "libx265", "-pix_fmt", "yuv420p"],
+    "vp9": ["-c:v", "libvpx-vp9", "-pix_fmt", "yuv420p", "-b:v", "0", "-row-mt", "1"],
+}
+
+# VP9 only encodes with constant quality if a CRF is given
+DEFAULT_CRF = {"vp9": 32}
+
+# Video codecs of every container, the first one is the default
+CONTAINER_CODECS = {
+    "mp4": ("h264", "h265"),
+    "mkv": ("h264", "h265", "vp9"),
+    "webm": ("vp9",),
+    "gif": ("gif",),
+}
+
+# Audio codecs that are copied into a container (None for all), and how other codecs
+# are encoded
+CONTAINER_AUDIO = {
+    "mp4": (("aac", "mp3", "alac"), ["-c:a", "aac", "-b:a", "192k"]),
+    "mkv": (None, None),
+    "webm": (("opus", "vorbis"), ["-c:a", "libopus", "-b:a", "128k"]),
+}
+
+# How an output with a different aspect ratio than the frames is filled
+FIT_MODES = ("crop", "pad")
+
+GIF_WIDTH = 480
+GIF_FRAMERATE = 15
+GIF_DURATION = 5
+
+def get_profiles(settings, outputs=None):
+    # Fills in the defaults of the requested outputs. Without outputs a render has a
+    # single MP4 at the size of the settings.
+    outputs = outputs or [{}]
+    profiles = []
+    for output in outputs:
+        container = output.get("container", "mp4")
+        if container not in CONTAINER_CODECS:
+            raise ValueError(f"Unsupported container: {container}")
+        codec = output.get("codec", CONTAINER_CODECS[container][0])
+        if codec not in CONTAINER_CODECS[container]:
+            raise ValueError(f"A {container} file cannot contain {codec}")
+        fit = output.get("fit", "crop")
+        if fit not in FIT_MODES:
+            raise ValueError(f"Unsupported fit: {fit}")
+        width, height = get_profile_size(settings, output, container)
+
+        name = output.get("name")
+        if name is None and len(outputs) > 1:
+            name = f"{width}x{height}"
+        is_gif = container == "gif"
+        profiles.append({
+            "name": sanitize_filename(str(name)) if name is not None else None,
+            "width": width,
+            "height": height,
+            "container": container,
+            "codec": codec,
+            "crf": output.get("crf"),
+            "preset": output.get("preset"),
+            "fit": fit,
+            "duration": output.get("duration", GIF_DURATION if is_gif else None),
+            "framerate": output.get("framerate", GIF_FRAMERATE) if is_gif else None,
+        })
+
+    if all(is_gif_profile(profile) for profile in profiles):
+        raise ValueError("GIF previews need a video output to be cut from")
+    filenames = [get_output_filename("", profile) for profile in profiles]
+    if len(set(filenames)) < len(filenames):
+        raise ValueError("Outputs need different names")
+    return profiles
+
+def get_profile_size(settings, output, container):
+    if container == "gif" and "width" not in output and "height" not in output:
+        width = min(GIF_WIDTH, settings["width"])
+        height = width * settings["height"] / settings["width"]
+    else:
+        width = output.get("width", settings["width"])
+        height = output.get("height", settings["height"])
+    # yuv420p needs even sizes
+    width, height = int(width) // 2 * 2, int(height) // 2 * 2
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Invalid output size: {width}x{height}")
+    return width, height
+
+def is_gif_profile(profile):
+    return profile["container"] == "gif"
+
+def get_output_filename(filename, profile):
+    if profile["name"]:
+        return f"{filename}-{profile['name']}.{profile['container']}"
+    return f"{filename}.{profile['container']}"
+
+def get_render_size(settings, profiles):
+    # The size the frames are rendered at: the size of the settings, scaled up until
+    # every output is a downscale of it
+    width, height = settings["width"], settings["height"]
+    scale = 1
+    for profile in profiles:
+        scale_x, scale_y = profile["width"] / width, profile["height"] / height
+        scale = max(scale, max(scale_x, scale_y) if profile["fit"] == "crop" else min(scale_x, scale_y))
+    if scale == 1:
+        return width, height
+    return -int(-width * scale // 2) * 2, -int(-height * scale // 2) * 2
+
+def get_filter_graph(profiles, width, height, background_color):
+    # Filter arguments and the stream of every profile
+    chains = [get_scale_filter(profile, width, height, background_color) for profile in profiles]
+    if len(profiles) == 1 and chains[0] is None:
+        return [], ["0:v:0"]
+    labels = [f"[v{i}]" for i in range(len(profiles))]
+    if len(profiles) == 1:
+        graph = [f"[0:v]{chains[0]}{labels[0]}"]
+    else:
+        graph = [f"[0:v]split={len(profiles)}" + "".join(f"[s{i}]" for i in range(len(profiles)))]
+        graph += [f"[s{i}]{chain or 'null'}{label}" for i, (chain, label) in enumerate(zip(chains, labels))]
+    return ["-filter_complex", ";".join(graph)], labels
+
+def get_scale_filter(profile, width, height, background_color):
+    # None if the frames already have the size of the output
+    filters = [f"fps={profile['framerate']}"] if profile["framerate"] else []
+    output_width, output_height = profile["width"], profile["height"]
+    if (output_width, output_height) != (width, height):
+        if profile["fit"] == "crop":
+            filters.append(f"scale={output_width}:{output_height}:force_original_aspect_ratio=increase:flags=lanczos")
+            filters.append(f"crop={output_width}:{output_height}")
+        else:
+            blue, green, red = hex_to_bgr(background_color)
+            filters.append(f"scale={output_width}:{output_height}:force_original_aspect_ratio=decrease:flags=lanczos")
+            filters.append(f"pad={output_width}:{output_height}:(ow-iw)/2:(oh-ih)/2:color=0x{red:02x}{green:02x}{blue:02x}")
+    return ",".join(filters) or None
+
+def get_video_args(profile, gop_frames=None):
+    args = list(VIDEO_CODECS[profile["codec"]])
+    crf = profile["crf"] if profile["crf"] is not None else DEFAULT_CRF.get(profile["codec"])
+    if crf is not None:
+        args += ["-crf", str(crf)]
+    if profile["preset"] and profile["codec"] in ("h264", "h265"):
+        args += ["-preset", str(profile["preset"])]
+    if gop_frames:
+        args += ["-g", str(gop_frames)]
+    return args
+
+def get_audio_input(audio_path, start, end):
+    # Only the rendered part of the track is read
+    seek = ["-ss", str(start)] if start else []
+    return [*seek, "-t", str(end - start), "-i", audio_path]
+
+def get_audio_args(profile, audio_codec):
+    copied_codecs, encode_args = CONTAINER_AUDIO[profile["container"]]
+    if copied_codecs is None or audio_codec in copied_codecs:
+        return ["-c:a", "copy"]
+    return list(encode_args)
+
+def get_encode_command(video_input, profiles, render_size, background_color, output_files, audio_input=None, audio_codec=None, gop_frames=None):
+    # A single FFmpeg command that encodes the input video to every profile. Without
+    # audio input the outputs only contain the video.
+    filter_args, labels = get_filter_graph(profiles, *render_size, background_color)
+    command = [*FFMPEG, *video_input, *(audio_input or []), *filter_args]
+    for profile, label, output_file in zip(profiles, labels, output_files):
+        command += ["-map", label, *get_video_args(profile, gop_frames)]
+        if audio_input:
+            command += ["-map", "1:a:0", *get_audio_args(profile, audio_codec), "-shortest"]
+        else:
+            command.append("-an")
+        if profile["duration"]:
+            command += ["-t", str(profile["duration"])]
+        command.append(output_file)
+    return command
+
+def get_mux_command(video_input, profile, audio_input, audio_codec, output_file):
+    # Adds the audio to an encoded video without encoding the video again
+    command = [
+        *FFMPEG,
+        *video_input,
+        *audio_input,
+        "-map", "0:v:0",
+        "-c:v", "copy",
+        "-map", "1:a:0",
+        *get_audio_args(profile, audio_codec),
+        "-shortest",
+    ]
+    if profile["duration"]:
+        command += ["-t", str(profile["duration"])]
+    return [*command, output_file]
+
+def get_gif_command(video_file, video_size, profile, background_color, output_file):
+    chain = get_scale_filter(profile, *video_size, background_color)
+    duration = ["-t", str(profile["duration"])] if profile["duration"] else []
+    return [
+        *FFMPEG,
+        *duration,
+        "-i", video_file,
+        "-filter_complex", f"[0:v]{chain},split[a][b];[a]palettegen[p];[b][p]paletteuse",
+        "-loop", "0",
+        output_file,
+    ]
@@ -0,0 +1,201 @@
+from scripts.rendering import render_frame
+from scripts.entrypoint import analysis_cache, upload_store, upload_index, get_analysis_key, get_cached_analysis, get_analysis, get_frame_reference, get_frame_data_at, get_frame_data_range
+
+import numpy as np
+import cv2
+
+import os
+import json
+import zlib
+import hashlib
+import threading
+import functools
+import collections
+
+# Preview images rendered and encoded in memory.
+#
+# A preview is either the first frame of the bundled sample audio or the frame of an
+# uploaded track at a given time, taken from the same cached analysis the video is
+# rendered from. Encoded images are kept in an LRU cache keyed on the settings that
+# change the image, so moving a slider back and forth is answered without rendering.
+# The normalization reference of a track only depends on its analysis and is cached
+# as well, so that a preview of a track only touches the rows around its frame.
+#
+# For playback in the browser, the normalized frame data itself is served in chunks of
+# frames, quantized to uint8 and compressed. The browser draws the frames in sync with
+# the audio, so previewing a whole song costs one analysis and no rendering or encoding.
+
+PREVIEW_FORMATS = {
+    "jpeg": ("image/jpeg", ".jpg", [cv2.IMWRITE_JPEG_QUALITY, 90]),
+    "webp": ("image/webp", ".webp", [cv2.IMWRITE_WEBP_QUALITY, 90]),
+}
+
+# Settings that have no influence on the image
+IGNORED_SETTINGS = ("fileName",)
+
+# Settings that have an influence on the frame data, the others only change how it is drawn
+FRAME_DATA_SETTINGS = ("visualization", "framerate", "startEnd", "minMaxFrequency", "bins", "binScale", "smoothing")
+
+# Upper bound of the frames in a chunk, a minute at 60 fps
+MAX_FRAME_DATA_CHUNK = 3600
+
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get("PREVIEW_CACHE_MAX_BYTES", 64 * 1024**2))
+MAX_FRAME_REFERENCES = 32
+
+SAMPLE_AUDIO_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "_sample_audio.npz")
+
+class PreviewCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._images = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            if key in self._images:
+                self._bytes -= len(self._images.pop(key))
+            self._images[key] = image
+            self._bytes += len(image)
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0,
+                "entries": len(self._images),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+preview_cache = PreviewCache(PREVIEW_CACHE_MAX_BYTES)
+
+_frame_references = collections.OrderedDict()
+_frame_references_lock = threading.Lock()
+
+def get_preview_image(settings, audio_path=None, timestamp=None, image_format="jpeg"):
+    # Returns the encoded image and its media type
+    media_type, extension, params = PREVIEW_FORMATS[image_format]
+    ignored = IGNORED_SETTINGS
+    if audio_path is None:
+        # The sample is always analyzed as a whole, its time range does not matter
+        source = "sample"
+        frame_index = 0
+        ignored += ("startEnd",)
+    else:
+        source = analysis_cache.get_file_hash(audio_path)
+        start = settings["startEnd"][0]
+        frame_index = int(max((timestamp if timestamp is not None else start) - start, 0) * settings["framerate"])
+
+    key = get_preview_key(normalize_settings(settings, ignored), source, frame_index, image_format)
+    image = preview_cache.get(key)
+    if image is None:
+        if audio_path is None:
+            frame_data = get_sample_frame_data(settings)
+        else:
+            frame_data = get_track_frame_data(audio_path, settings, frame_index)
+        _, buffer = cv2.imencode(extension, render_frame(frame_data, settings), params)
+        image = buffer.tobytes()
+        preview_cache.put(key, image)
+    return image, media_type
+
+def get_frame_data_chunk(audio_path, settings, start, count):
+    # Frames start to start + count of a track as uint8 (one row of bins per frame, or a
+    # single value for volume), compressed with zlib. Returns the compressed data, its
+    # first frame and number of frames, the values per frame and the frames of the track.
+    with upload_store.pin(audio_path):
+        analysis = get_cached_analysis(audio_path, settings)
+        sr = upload_index.get_sample_rate(audio_path)
+    total = len(analysis)
+    start = min(max(start, 0), total)
+    end = min(start + min(count, MAX_FRAME_DATA_CHUNK), total)
+    values = 1 if settings["visualization"] == "volume" else settings["bins"]
+
+    data_settings = {key: settings[key] for key in FRAME_DATA_SETTINGS if key in settings}
+    key = get_preview_key(normalize_settings(data_settings, ()), analysis_cache.get_file_hash(audio_path), [start, end], "frames")
+    data = preview_cache.get(key)
+    if data is None:
+        reference = get_cached_frame_reference(get_reference_key(audio_path, settings), analysis, sr, settings)
+        frames = get_frame_data_range(analysis, sr, settings, start, end, reference) if end > start else np.zeros(0)
+        data = zlib.compress(np.rint(np.asarray(frames) * 255).astype(np.uint8).tobytes())
+        preview_cache.put(key, data)
+    return data, start, end - start, values, total
+
+def get_preview_key(settings, source, frame_index, image_format):
+    description = json.dumps([settings, source, frame_index, image_format], sort_keys=True)
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+def normalize_settings(settings, ignored):
+    # Equal settings should give equal keys, no matter how the client wrote them
+    return {key: normalize_value(value) for key, value in settings.items() if key not in ignored}
+
+def normalize_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item) for item in value]
+    if isinstance(value, str) and value.startswith("#"):
+        return value.lower()
+    return value
+
+def get_track_frame_data(audio_path, settings, frame_index):
+    with upload_store.pin(audio_path):
+        analysis = get_cached_analysis(audio_path, settings)
+        sr = upload_index.get_sample_rate(audio_path)
+    reference = get_cached_frame_reference(get_reference_key(audio_path, settings), analysis, sr, settings)
+    return get_frame_data_at(analysis, sr, settings, min(frame_index, len(analysis) - 1), reference)
+
+def get_reference_key(audio_path, settings):
+    # Volume has no bins, its reference only depends on the analysis
+    if settings["visualization"] == "volume":
+        return (get_analysis_key(audio_path, settings),)
+    return (get_analysis_key(audio_path, settings), settings["bins"], settings.get("binScale", "linear"))
+
+def get_sample_frame_data(settings):
+    if (settings["visualization"] == "volume"):
+        return 1
+    min_freq, max_freq = settings["minMaxFrequency"]
+    analysis, sr = get_sample_analysis(settings["visualization"], settings["framerate"], min_freq, max_freq)
+    reference_key = ("sample", settings["framerate"], min_freq, max_freq, settings["bins"], settings.get("binScale", "linear"))
+    reference = get_cached_frame_reference(reference_key, analysis, sr, settings)
+    return get_frame_data_at(analysis, sr, settings, 0, reference)
+
+@functools.lru_cache(maxsize=16)
+def get_sample_analysis(visualization, framerate, min_freq, max_freq):
+    sample_data = np.load(SAMPLE_AUDIO_PATH)
+    sr = int(sample_data["sr"])
+    settings = {"visualization": visualization, "framerate": framerate, "minMaxFrequency": [min_freq, max_freq]}
+    analysis = get_analysis(sample_data["y"], sr, settings)
+    analysis.flags.writeable = False
+    return analysis, sr
+
+def get_cached_frame_reference(key, analysis, sr, settings):
+    with _frame_references_lock:
+        reference = _frame_references.get(key)
+        if reference is not None:
+            _frame_references.move_to_end(key)
+            return reference
+
+    reference = get_frame_reference(analysis, sr, settings)
+    with _frame_references_lock:
+        _frame_references[key] = reference
+        if len(_frame_references) > MAX_FRAME_REFERENCES:
+            _frame_references.popitem(last=False)
+    return reference
@@ -0,0 +1,355 @@
+import numpy as np
+import cv2
+import functools
+
+# Vectorized drawing for the bar and point spectrum styles.
+#
+# Every shape these styles draw covers a single contiguous run of rows in each pixel
+# column it touches, so a frame can be described per column as "rows a to b are filled".
+# The column geometry only depends on the canvas size and the style settings and is
+# computed once. A frame (or a whole batch of frames) is then rasterized by comparing a
+# row index against per-column bounds, which reproduces the cv2 draw calls pixel for pixel.
+#
+# For native anti-aliasing, shapes are drawn at the target size with analytic coverage
+# instead, and every pixel is blended by the part of its area the shapes cover. Boxes
+# cover exactly the product of the covered parts of a pixel's column and row. Circles
+# and lines use the distance of the pixel center to their edge, which is evaluated only
+# around every shape.
+
+RASTERIZED_STYLES = {
+    "bar": ("simple", "lcd"),
+    "point": ("circle", "square", "donut"),
+}
+
+COVERAGE_STYLES = {
+    "bar": ("simple",),
+    "point": ("circle", "square", "donut"),
+    "line": ("simple", "filled"),
+}
+
+def can_rasterize(settings):
+    return settings["styleVariant"] in RASTERIZED_STYLES.get(settings["style"], ())
+
+def can_rasterize_coverage(settings):
+    return settings["styleVariant"] in COVERAGE_STYLES.get(settings["style"], ())
+
+def rasterize_spectrum(frames, settings, shape, color, bg_color):
+    # frames: (frames, bins) array of values in [0, 1], returns (frames, height, width, 3)
+    frames = np.asarray(frames)
+    height, width = shape
+    num_bins = frames.shape[1]
+    geometry = get_column_geometry(height, width, num_bins, settings["style"], settings["styleVariant"], float(settings["binWidth"]))
+
+    if settings["styleVariant"] == "lcd":
+        mask = rasterize_lcd(frames, geometry, height)
+    elif settings["styleVariant"] == "simple":
+        mask = rasterize_bars(frames, geometry, height)
+    else:
+        mask = rasterize_intervals(frames, geometry, height, settings["styleVariant"])
+
+    return paint_mask(mask, color, bg_color)
+
+def paint_mask(mask, color, bg_color):
+    # Per channel lookup of 0 -> background and 1 -> color, much cheaper than boolean indexing
+    num_frames, height, width = mask.shape
+    mask = mask.view(np.uint8).reshape(num_frames * height, width)
+    channels = []
+    for channel in range(3):
+        table = np.zeros(256, dtype=np.uint8)
+        table[0] = bg_color[channel]
+        table[1] = color[channel]
+        channels.append(cv2.LUT(mask, table))
+    return cv2.merge(channels).reshape(num_frames, height, width, 3)
+
+def rasterize_coverage(frames, settings, shape, color, bg_color):
+    # frames: (frames, bins) array of values in [0, 1], returns (frames, height, width, 3)
+    frames = np.asarray(frames, dtype=np.float64)
+    height, width = shape
+    style, variant = settings["style"], settings["styleVariant"]
+
+    coverage = np.empty((frames.shape[0], height, width), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        if style == "line" and variant == "filled":
+            frame_coverage = get_filled_line_coverage(frame, height, width)
+        elif style == "line":
+            frame_coverage = get_line_coverage(frame, height, width, settings["lineThickness"], settings["polarWarp"])
+        elif variant in ("circle", "donut"):
+            frame_coverage = get_circle_coverage(frame, height, width, float(settings["binWidth"]), variant == "donut")
+        else:
+            frame_coverage = get_box_coverage(frame, height, width, variant, float(settings["binWidth"]))
+        coverage[i] = np.rint(frame_coverage * 255)
+    return paint_coverage(coverage, color, bg_color)
+
+def get_box_coverage(frame, height, width, variant, bin_width_factor):
+    bins, column_coverage, side = get_coverage_geometry(height, width, len(frame), variant, bin_width_factor)
+    # Top edge of every box, the extra bin for padded layers is below the canvas
+    tops = np.append(height * (1 - frame), height).astype(np.float32)
+    rows = np.arange(height, dtype=np.float32)[:, None]
+    coverage = np.zeros((height, width), dtype=np.float32)
+    for layer in range(bins.shape[0]):
+        top = tops[bins[layer]][None, :]
+        # Bars reach down to the bottom of the canvas, squares are side pixels high
+        bottom = top + side if side is not None else height
+        coverage += column_coverage[layer] * np.clip(np.minimum(rows + 1, bottom) - np.maximum(rows, top), 0, 1)
+    return np.minimum(coverage, 1)
+
+def get_circle_coverage(frame, height, width, bin_width_factor, donut):
+    # Circles sit on top of their value like the rasterized ones
+    coverage = np.zeros((height, width), dtype=np.float32)
+    radius = width / len(frame) / 2
+    for i, value in enumerate(frame):
+        center_x = radius * (2 * i + 1)
+        center_y = height * (1 - value) + radius
+        add_circle(coverage, center_x, center_y, radius * bin_width_factor)
+        if donut:
+            add_circle(coverage, center_x, center_y, radius * bin_width_factor / 2, cut=True)
+    return coverage
+
+def get_line_coverage(frame, height, width, line_thickness, closed):
+    # The line ends at the bottom right corner, or goes back to its start for polar warp
+    bin_width = width / len(frame)
+    x_coords = bin_width * np.arange(len(frame) + 1)
+    y_coords = np.append(height * (1 - frame), height * (1 - frame[0]) if closed else height)
+    # As wide as the cv2 lines of 2x supersampling, which are a canvas pixel wider than their thickness
+    half_width = (line_thickness + 0.5) / 2
+    coverage = np.zeros((height, width), dtype=np.float32)
+    for i in range(len(frame)):
+        add_segment(coverage, x_coords[i], y_coords[i], x_coords[i + 1], y_coords[i + 1], half_width)
+    return coverage
+
+def get_filled_line_coverage(frame, height, width):
+    # Area below the line through the values, which ends at the start of the last bin.
+    # The signed distance of a pixel center to the edge gives its coverage.
+    num_bins = len(frame)
+    if num_bins < 2:
+        return np.zeros((height, width), dtype=np.float32)
+    bin_width = width / num_bins
+    y_coords = height * (1 - frame)
+    x_centers = np.arange(width) + 0.5
+    segment = np.clip((x_centers // bin_width).astype(np.intp), 0, num_bins - 2)
+    slope = (y_coords[segment + 1] - y_coords[segment]) / bin_width
+    edge = y_coords[segment] + slope * (x_centers - bin_width * segment)
+    column_coverage = np.clip(np.minimum(x_centers + 0.5, bin_width * (num_bins - 1)) - (x_centers - 0.5), 0, 1)
+    rows = np.arange(height)[:, None] + 0.5
+    distance = (rows - edge[None, :]) / np.sqrt(1 + slope**2)[None, :]
+    return (np.clip(distance + 0.5, 0, 1) * column_coverage[None, :]).astype(np.float32)
+
+def add_circle(coverage, center_x, center_y, radius, cut=False):
+    # Adds a filled circle to the coverage, or cuts it out of the coverage
+    if radius <= 0:
+        return
+    stamp = get_stamp(coverage.shape, center_x - radius, center_y - radius, center_x + radius, center_y + radius)
+    if stamp is None:
+        return
+    rows, columns, y, x = stamp
+    circle = np.clip(radius + 0.5 - np.sqrt((x - center_x)**2 + (y - center_y)**2), 0, 1)
+    if cut:
+        coverage[rows, columns] *= 1 - circle
+    else:
+        np.maximum(coverage[rows, columns], circle, out=coverage[rows, columns])
+
+def add_segment(coverage, x1, y1, x2, y2, half_width):
+    # Adds a line segment with round ends, half_width pixels to both sides
+    stamp = get_stamp(coverage.shape, min(x1, x2) - half_width, min(y1, y2) - half_width, max(x1, x2) + half_width, max(y1, y2) + half_width)
+    if stamp is None:
+        return
+    rows, columns, y, x = stamp
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = np.clip(((x - x1) * dx + (y - y1) * dy) / length, 0, 1) if length > 0 else 0
+    distance = np.sqrt((x - x1 - t * dx)**2 + (y - y1 - t * dy)**2)
+    segment = np.clip(half_width + 0.5 - distance, 0, 1)
+    np.maximum(coverage[rows, columns], segment, out=coverage[rows, columns])
+
+def get_stamp(shape, left, top, right, bottom):
+    # Pixels around a shape's bounding box and the coordinates of their centers
+    height, width = shape
+    x1, y1 = max(int(np.floor(left)) - 1, 0), max(int(np.floor(top)) - 1, 0)
+    x2, y2 = min(int(np.ceil(right)) + 1, width), min(int(np.ceil(bottom)) + 1, height)
+    if x1 >= x2 or y1 >= y2:
+        return None
+    return slice(y1, y2), slice(x1, x2), np.arange(y1, y2)[:, None] + 0.5, np.arange(x1, x2)[None, :] + 0.5
+
+def paint_coverage(coverage, color, bg_color):
+    # Blends background and color by the coverage in 0..255 with a per channel lookup
+    num_frames, height, width = coverage.shape
+    coverage = coverage.reshape(num_frames * height, width)
+    alpha = np.arange(256) / 255
+    channels = []
+    for channel in range(3):
+        table = np.rint(bg_color[channel] + alpha * (color[channel] - bg_color[channel])).astype(np.uint8)
+        channels.append(cv2.LUT(coverage, table))
+    return cv2.merge(channels).reshape(num_frames, height, width, 3)
+
+@functools.lru_cache(maxsize=16)
+def get_coverage_geometry(height, width, num_bins, variant, bin_width_factor):
+    # Per layer the bin of every pixel column and the part of the column its box covers
+    bin_width = width / num_bins
+    offset = bin_width * (1 - bin_width_factor) / 2
+    columns = [[] for _ in range(width)]
+    for i in range(num_bins):
+        x1 = bin_width * i + offset
+        x2 = bin_width * (i + 1) - offset
+        for x in range(int(x1), min(int(np.ceil(x2)), width)):
+            covered = min(x + 1, x2) - max(x, x1)
+            if covered > 0:
+                columns[x].append((i, covered))
+    num_layers = max(1, max(len(column) for column in columns))
+
+    bins = np.full((num_layers, width), num_bins, dtype=np.intp)
+    column_coverage = np.zeros((num_layers, width), dtype=np.float32)
+    for x, column in enumerate(columns):
+        for layer, (i, covered) in enumerate(column):
+            bins[layer, x] = i
+            column_coverage[layer, x] = covered
+    side = bin_width * bin_width_factor if variant == "square" else None
+    return bins, column_coverage, side
+
+def rasterize_bars(frames, geometry, height):
+    # Bars are open towards the bottom, so each column only needs its highest top row
+    bins = geometry[0]
+    base = get_base_rows(frames, height, "simple", None)
+    base = np.concatenate([base, np.full((base.shape[0], 1), height, dtype=base.dtype)], axis=1)
+    column_top = base[:, bins[0]]
+    for layer in range(1, bins.shape[0]):
+        column_top = np.minimum(column_top, base[:, bins[layer]])
+    rows = np.arange(height, dtype=np.int32)[None, :, None]
+    return rows >= column_top[:, None, :]
+
+def rasterize_intervals(frames, geometry, height, variant):
+    bins, top, bottom, hole_top, hole_bottom, sprite = geometry
+    base = get_base_rows(frames, height, variant, sprite)
+    # Extra bin for padded layers, its interval is always empty
+    base = np.concatenate([base, np.zeros((base.shape[0], 1), dtype=base.dtype)], axis=1)
+    rows = np.arange(height, dtype=np.int32)[None, :, None]
+
+    mask = np.zeros((frames.shape[0], height, bins.shape[1]), dtype=bool)
+    for layer in range(bins.shape[0]):
+        layer_base = base[:, bins[layer]][:, None, :]
+        mask |= (rows >= layer_base + top[layer]) & (rows <= layer_base + bottom[layer])
+        if variant == "donut":
+            mask &= ~((rows >= layer_base + hole_top[layer]) & (rows <= layer_base + hole_bottom[layer]))
+    return mask
+
+def rasterize_lcd(frames, geometry, height):
+    bins, first_row, row_height = geometry
+    max_rows = height / row_height
+    lit_rows = np.rint(frames * max_rows).astype(np.int32)
+    lit_rows = np.concatenate([lit_rows, np.zeros((lit_rows.shape[0], 1), dtype=np.int32)], axis=1)
+
+    column_rows = lit_rows[:, bins[0]]
+    for layer in range(1, bins.shape[0]):
+        column_rows = np.maximum(column_rows, lit_rows[:, bins[layer]])
+    return first_row[None, :, None] < column_rows[:, None, :]
+
+def get_base_rows(frames, height, variant, sprite):
+    # Row that the per-column offsets are relative to, computed exactly like the cv2 path
+    if variant in ("circle", "donut"):
+        radius = sprite
+        point_height = (height * frames - radius).astype(np.int32)
+        return height - point_height
+    bar_height = (height * frames).astype(np.int32)
+    return height - bar_height
+
+@functools.lru_cache(maxsize=16)
+def get_column_geometry(height, width, num_bins, style, variant, bin_width_factor):
+    if variant in ("circle", "donut"):
+        return get_point_geometry(height, width, num_bins, variant, bin_width_factor)
+
+    bin_width = width / num_bins
+    offset = bin_width * (1 - bin_width_factor) / 2
+    spans = []
+    for i in range(num_bins):
+        x1 = int(bin_width * i + offset)
+        x2 = int(bin_width * (i + 1) - offset)
+        spans.append([(x, 0, 0) for x in range(x1, x2 + 1)])
+
+    if variant == "lcd":
+        row_height = int(bin_width - 2 * offset)
+        if row_height <= 0:
+            raise ZeroDivisionError("LCD bars need a bin width of at least one pixel")
+        bins, _, _ = build_layers(spans, width, num_bins)
+        return bins, get_lcd_first_rows(height, row_height), row_height
+
+    if variant == "square":
+        side = int(bin_width - 2 * offset)
+        spans = [[(x, 0, side) for x, _, _ in span] for span in spans]
+    else:
+        spans = [[(x, 0, height) for x, _, _ in span] for span in spans]
+    bins, top, bottom = build_layers(spans, width, num_bins)
+    return bins, top, bottom, None, None, None
+
+def get_point_geometry(height, width, num_bins, variant, bin_width_factor):
+    radius = width / num_bins / 2
+    outer = get_circle_sprite(int(radius * bin_width_factor))
+    inner = get_circle_sprite(int(radius * bin_width_factor / 2))
+
+    spans = []
+    holes = {}
+    for i in range(num_bins):
+        x = int(width / num_bins * i + radius)
+        spans.append([(x + dx, top, bottom) for dx, (top, bottom) in outer.items()])
+        for dx, (top, bottom) in inner.items():
+            holes[(i, x + dx)] = (top, bottom)
+    bins, top, bottom = build_layers(spans, width, num_bins)
+
+    # Hole bounds per layer, columns without a hole get an empty interval
+    hole_top = np.ones_like(top)
+    hole_bottom = np.zeros_like(bottom)
+    for layer in range(bins.shape[0]):
+        for x in range(width):
+            hole = holes.get((bins[layer, x], x))
+            if hole is not None:
+                hole_top[layer, x], hole_bottom[layer, x] = hole
+    return bins, top, bottom, hole_top, hole_bottom, radius
+
+def build_layers(spans, width, num_bins):
+    # Sorts the per-bin column spans into layers, so that every pixel column holds at
+    # most one shape per layer. Layers keep bin order, which preserves the draw order.
+    columns = [[] for _ in range(width)]
+    for i, span in enumerate(spans):
+        for x, top, bottom in span:
+            if 0 <= x < width:
+                columns[x].append((i, top, bottom))
+    num_layers = max(1, max(len(column) for column in columns))
+
+    bins = np.full((num_layers, width), num_bins, dtype=np.intp)
+    top = np.ones((num_layers, width), dtype=np.int32)
+    bottom = np.zeros((num_layers, width), dtype=np.int32)
+    for x, column in enumerate(columns):
+        for layer, (i, t, b) in enumerate(column):
+            bins[layer, x] = i
+            top[layer, x] = t
+            bottom[layer, x] = b
+    return bins, top, bottom
+
+@functools.lru_cache(maxsize=16)
+def get_circle_sprite(radius):
+    # Row extent of each column of a filled cv2 circle, relative to its center
+    size = 2 * radius + 3
+    canvas = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(canvas, (radius + 1, radius + 1), radius, 255, -1)
+    sprite = {}
+    for column in range(size):
+        filled = np.nonzero(canvas[:, column])[0]
+        if len(filled):
+            sprite[column - radius - 1] = (int(filled[0]) - radius - 1, int(filled[-1]) - radius - 1)
+    return sprite
+
+def get_lcd_first_rows(height, row_height):
+    # Index of the lowest LCD row that covers each pixel row, so that a pixel row is lit
+    # when that index is below the number of lit LCD rows of its bin
+    first_row = np.full(height, np.iinfo(np.int32).max, dtype=np.int32)
+    row = 0
+    while True:
+        y1 = height - int(row_height * (row + 0.5)) + 1
+        y2 = height - int(row_height * row)
+        # cv2.rectangle swaps inverted corners, which happens for one pixel high rows
+        y1, y2 = min(y1, y2), max(y1, y2)
+        if y2 < 0:
+            break
+        y1, y2 = max(y1, 0), min(y2, height - 1)
+        if y1 <= y2:
+            first_row[y1:y2 + 1] = np.minimum(first_row[y1:y2 + 1], row)
+        row += 1
+    return first_row
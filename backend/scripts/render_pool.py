@@ -0,0 +1,380 @@
+from scripts.rendering import render_frames, prepare_render, get_canvas_size
+from scripts.jobs import check_cancelled, JobCancelled
+from scripts.metrics import Counter, record_worker_spans
+
+import numpy as np
+import cv2
+
+import os
+import time
+import uuid
+import pickle
+import shutil
+import subprocess
+import tempfile
+import threading
+import functools
+import collections
+import multiprocessing
+import concurrent.futures
+
+# Long-lived pool of render processes shared by all render jobs.
+#
+# The settings of a job are written once to a small file in the scratch directory of
+# the pool. Tasks only carry the job key and their frames, a worker loads the settings
+# (and warms up colors, geometry and polar maps) the first time it sees a job. Frames
+# are sent in chunks whose size adapts to the measured render time, and only a bounded
+# number of chunks is in flight per job, so memory stays flat on long tracks. Workers
+# time what they do and return the spans with their results.
+#
+# Jobs that render at the same time share the workers fairly: tasks wait in a queue per
+# job, and a dispatcher thread hands them to the workers round robin over the jobs,
+# keeping only a few tasks per worker in the executor. A job that submits all of its
+# segments at once cannot make the jobs after it wait until it is done.
+
+# Render time a chunk should take, long enough to hide the IPC overhead
+TARGET_CHUNK_SECONDS = 0.1
+MAX_CHUNK_FRAMES = 64
+
+# Chunks in flight per worker and job
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+# Segment renders: segments per worker, most frames rendered between checks for
+# cancellation, and how often a failing segment is tried
+SEGMENTS_PER_WORKER = 4
+SEGMENT_CHUNK_FRAMES = 16
+SEGMENT_ATTEMPTS = 3
+
+# Canvas bytes a segment renders at once. A batch peaks at about 2.5 times its canvases,
+# 16 frames of 1920x1080 with 2x supersampling took 1 GB per worker.
+SEGMENT_CHUNK_BYTES = 64 << 20
+
+# Job states kept per worker process
+MAX_WORKER_JOBS = 8
+
+# Tasks per worker handed to the executor, enough to keep the workers busy between two
+# dispatches
+TASKS_DISPATCHED_PER_WORKER = 2
+
+_worker_jobs = collections.OrderedDict()
+
+SEGMENT_RETRIES = Counter("visualizer_segment_retries_total", "Segments rendered again after a failure")
+POOL_RESTARTS = Counter("visualizer_render_pool_restarts_total", "Render pools replaced after a worker died")
+
+class RenderPool:
+    def __init__(self, num_workers=None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.executor = None
+        self.state_dir = None
+        self.tasks = 0
+        self._lock = threading.Lock()
+        # Job key -> tasks waiting to be dispatched, in the order the jobs take turns
+        self._queues = collections.OrderedDict()
+        self._dispatched = 0
+        self._dispatch_condition = threading.Condition(self._lock)
+        self._dispatcher = None
+
+    def render(self, frame_data, settings, output_dir=None, cancel_event=None):
+        # Renders the frames and yields the raw BGR bytes of every chunk in order. With
+        # output_dir the frames are saved as numbered PNGs instead and empty chunks are
+        # yielded, so that progress can still be followed.
+        job_key, state_path = self._create_job(settings)
+
+        max_in_flight = self.num_workers * CHUNKS_IN_FLIGHT_PER_WORKER
+        pending = collections.deque()
+        chunk_size = 1
+        frame_index = 0
+        frames = iter(frame_data)
+        try:
+            while True:
+                while len(pending) < max_in_flight:
+                    chunk = np.asarray(list(next_chunk(frames, chunk_size)))
+                    if len(chunk) == 0:
+                        break
+                    pending.append((len(chunk), self._submit(job_key, render_chunk, state_path, job_key, frame_index, chunk, output_dir)))
+                    frame_index += len(chunk)
+                if not pending:
+                    break
+
+                check_cancelled(cancel_event)
+                num_frames, future = pending.popleft()
+                try:
+                    buffer, seconds, spans = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    # The job fails, but the jobs after it get a new pool
+                    self._replace_executor(future.executor)
+                    raise
+                record_worker_spans(spans)
+                chunk_size = get_chunk_size(seconds / num_frames)
+                yield num_frames, buffer
+        finally:
+            for _, future in pending:
+                future.cancel()
+            os.remove(state_path)
+
+    def render_segments(self, frames_path, segments, settings, encode_command, cancel_event=None):
+        # Renders and encodes the (start, end, output_files) segments of the frame data
+        # saved in frames_path. Every segment is handled by a single worker, which pipes
+        # its frames into an FFmpeg process of its own, so segments are rendered and
+        # encoded in parallel. The None entries of encode_command are replaced by the
+        # output files of the segment in order. Yields the number of frames of every
+        # finished segment. A failing segment is tried again on its own.
+        job_key, state_path = self._create_job(settings)
+        # Workers cannot see the cancel event, they check for this file instead
+        cancel_path = f"{state_path}.cancel"
+        attempts = collections.Counter()
+        running = {}
+
+        def submit(segment):
+            attempts[segment] += 1
+            future = self._submit(job_key, render_segment, state_path, job_key, cancel_path, frames_path, *segment, encode_command)
+            running[future] = segment
+
+        try:
+            for segment in segments:
+                submit(segment)
+            while running:
+                done, _ = concurrent.futures.wait(running, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+                check_cancelled(cancel_event)
+                for future in done:
+                    segment = running.pop(future)
+                    try:
+                        num_frames, spans = future.result()
+                    except Exception as e:
+                        if attempts[segment] >= SEGMENT_ATTEMPTS:
+                            raise
+                        print(f"Segment {segment[0]}-{segment[1]} failed ({e!r}), trying again")
+                        SEGMENT_RETRIES.inc()
+                        if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                            self._replace_executor(future.executor)
+                        submit(segment)
+                        continue
+                    record_worker_spans(spans)
+                    yield num_frames
+        finally:
+            if running:
+                # Segments that are still rendering stop at their next check and kill their FFmpeg
+                open(cancel_path, "w").close()
+                for future in running:
+                    future.cancel()
+                concurrent.futures.wait(running)
+            for path in (state_path, cancel_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def start(self):
+        # Starts the workers in the background, so that the first render does not wait
+        # for the processes to come up and import the rendering modules
+        executor = self._get_executor()
+        for _ in range(self.num_workers):
+            executor.submit(warm_up)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self.executor = self.executor, None
+            state_dir, self.state_dir = self.state_dir, None
+            dispatcher, self._dispatcher = self._dispatcher, None
+            queued = [task for queue in self._queues.values() for task in queue]
+            self._queues.clear()
+            self._dispatch_condition.notify_all()
+        # Outside of the lock, cancelled futures call back into the pool
+        for future, _, _ in queued:
+            future.cancel()
+        if dispatcher is not None:
+            dispatcher.join()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.num_workers, "tasks": self.tasks, "jobs": len(self._queues)}
+
+    def _create_job(self, settings):
+        self._get_executor()
+        job_key = uuid.uuid4().hex
+        state_path = os.path.join(self.state_dir, f"{job_key}.pickle")
+        with open(state_path, "wb") as f:
+            pickle.dump(settings, f)
+        return job_key, state_path
+
+    def _replace_executor(self, broken_executor):
+        # A worker that died takes the whole executor with it, the next task starts a new one
+        with self._lock:
+            if broken_executor is None or self.executor is not broken_executor:
+                return
+            self.executor = None
+            POOL_RESTARTS.inc()
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, job_key, fn, *args):
+        # Queues a task of a job and returns its future. The executor the task ends up in
+        # is set as the executor attribute of the future.
+        future = concurrent.futures.Future()
+        future.executor = None
+        with self._lock:
+            # Counts the tasks in the pool, whether they are queued or running
+            self.tasks += 1
+            self._queues.setdefault(job_key, collections.deque()).append((future, fn, args))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="render-pool-dispatcher", daemon=True)
+                self._dispatcher.start()
+            self._dispatch_condition.notify()
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            self.tasks -= 1
+
+    def _dispatch(self):
+        max_dispatched = self.num_workers * TASKS_DISPATCHED_PER_WORKER
+        current_thread = threading.current_thread()
+        while True:
+            with self._lock:
+                while self._dispatcher is current_thread and (not self._queues or self._dispatched >= max_dispatched):
+                    self._dispatch_condition.wait()
+                if self._dispatcher is not current_thread:
+                    return
+                # The job that waited longest goes first and then to the back of the line
+                job_key, queue = next(iter(self._queues.items()))
+                future, fn, args = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(job_key)
+                else:
+                    del self._queues[job_key]
+                self._dispatched += 1
+                # Taken within the lock, so that a pool that shuts down is not started again
+                future.executor = self._get_executor_locked()
+
+            # Tasks of a job that ended while they were queued are dropped here
+            if not future.set_running_or_notify_cancel():
+                self._dispatch_done(None, None)
+                continue
+            try:
+                executor_future = future.executor.submit(fn, *args)
+            except Exception as e:
+                self._dispatch_done(None, None)
+                future.set_exception(e)
+                continue
+            executor_future.add_done_callback(functools.partial(self._dispatch_done, future))
+
+    def _dispatch_done(self, future, executor_future):
+        with self._lock:
+            self._dispatched -= 1
+            self._dispatch_condition.notify()
+        if future is None:
+            return
+        if executor_future.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif executor_future.exception() is not None:
+            future.set_exception(executor_future.exception())
+        else:
+            future.set_result(executor_future.result())
+
+    def _get_executor(self):
+        with self._lock:
+            return self._get_executor_locked()
+
+    def _get_executor_locked(self):
+        if self.executor is None:
+            if self.state_dir is None:
+                self.state_dir = tempfile.mkdtemp(prefix="render-pool-")
+            # Spawned rather than forked, forked workers would inherit the stdin pipe of
+            # a running FFmpeg process and keep it from ever seeing the end of the input
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self.executor
+
+def warm_up():
+    pass
+
+def next_chunk(frames, chunk_size):
+    for _ in range(chunk_size):
+        try:
+            yield next(frames)
+        except StopIteration:
+            return
+
+def get_chunk_size(seconds_per_frame):
+    if seconds_per_frame <= 0:
+        return MAX_CHUNK_FRAMES
+    return int(np.clip(TARGET_CHUNK_SECONDS / seconds_per_frame, 1, MAX_CHUNK_FRAMES))
+
+def get_segment_chunk_size(settings):
+    # Fewer frames per batch as the resolution and supersampling grow
+    height, width = get_canvas_size(settings)
+    return int(np.clip(SEGMENT_CHUNK_BYTES // (height * width * 3), 1, SEGMENT_CHUNK_FRAMES))
+
+def render_chunk(state_path, job_key, frame_index, chunk, output_dir):
+    # Returns the rendered frames, the time they took and the spans of the worker
+    start_time = time.perf_counter()
+    settings = get_worker_job(state_path, job_key)
+    spans = []
+    render_start = time.time()
+    images = render_frames(chunk, settings)
+    spans.append(("render", render_start, time.time(), os.getpid(), len(chunk)))
+    if output_dir is not None:
+        write_start = time.time()
+        for i, img in enumerate(images):
+            cv2.imwrite(os.path.join(output_dir, f"{frame_index + i:05d}.png"), img)
+        spans.append(("write", write_start, time.time(), os.getpid(), None))
+        buffer = b""
+    else:
+        buffer = b"".join(img.tobytes() for img in images)
+    return buffer, time.perf_counter() - start_time, spans
+
+def render_segment(state_path, job_key, cancel_path, frames_path, start, end, output_files, encode_command):
+    settings = get_worker_job(state_path, job_key)
+    frame_data = np.load(frames_path, mmap_mode="r")
+    output_files = iter(output_files)
+    command = [next(output_files) if arg is None else arg for arg in encode_command]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    chunk_size = get_segment_chunk_size(settings)
+    spans = []
+    try:
+        for i in range(start, end, chunk_size):
+            if os.path.exists(cancel_path):
+                raise JobCancelled()
+            chunk = frame_data[i:min(i + chunk_size, end)]
+            render_start = time.time()
+            images = render_frames(chunk, settings)
+            write_start = time.time()
+            for img in images:
+                process.stdin.write(img.tobytes())
+            spans.append(("render", render_start, write_start, os.getpid(), len(chunk)))
+            spans.append(("write", write_start, time.time(), os.getpid(), None))
+        process.stdin.close()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    encode_start = time.time()
+    returncode = process.wait()
+    spans.append(("ffmpeg", encode_start, time.time(), os.getpid(), None))
+    if returncode != 0:
+        raise RuntimeError(f"FFmpeg failed with exit code {returncode}")
+    return end - start, spans
+
+def get_segments(num_frames, gop_frames, num_segments):
+    # Splits the frames into at most num_segments ranges of whole GOPs, so that every
+    # segment starts with a keyframe and the joined video keeps a regular GOP structure
+    num_gops = -(-num_frames // gop_frames)
+    segment_frames = max(1, -(-num_gops // num_segments)) * gop_frames
+    return [(start, min(start + segment_frames, num_frames)) for start in range(0, num_frames, segment_frames)]
+
+def get_worker_job(state_path, job_key):
+    settings = _worker_jobs.get(job_key)
+    if settings is None:
+        with open(state_path, "rb") as f:
+            settings = pickle.load(f)
+        prepare_render(settings)
+        _worker_jobs[job_key] = settings
+        if len(_worker_jobs) > MAX_WORKER_JOBS:
+            _worker_jobs.popitem(last=False)
+    else:
+        _worker_jobs.move_to_end(job_key)
+    return settings
@@ -1,6 +1,15 @@
 import numpy as np
 import cv2
-import matplotlib.colors as mcolors
+import re
+import functools
+
+from scripts.rasterization import can_rasterize, rasterize_spectrum, get_column_geometry, can_rasterize_coverage, rasterize_coverage, get_coverage_geometry, add_circle, paint_coverage
+
+# Anti-aliasing either draws on a canvas that is supersampling times larger and shrinks
+# it afterwards, or natively draws at the target size with the analytic pixel coverage
+# of the shapes, which costs about as much as no anti-aliasing at all
+ANTI_ALIASING_MODES = ("supersample", "native")
+SUPERSAMPLING_FACTORS = (1, 2, 3)
 
 def render_frame(data, settings):
     if (settings["visualization"] == "volume"):
@@ -8,6 +17,23 @@ def render_frame(data, settings):
     if (settings["visualization"] == "spectrum"):
         return render_spectrum(data, settings)
 
+def prepare_render(settings):
+    # Fills the per-process caches a job needs, so that its first frame is not slower than the rest
+    hex_to_bgr(settings["color"])
+    hex_to_bgr(settings["backgroundColor"])
+    get_supersampling(settings)
+    if settings["visualization"] != "spectrum":
+        return
+    height, width = get_canvas_size(settings)
+    rasterize = get_rasterizer(settings)
+    if rasterize is rasterize_coverage:
+        get_coverage_geometry(height, width, settings["bins"], settings["styleVariant"], float(settings["binWidth"]))
+    elif rasterize is rasterize_spectrum:
+        get_column_geometry(height, width, settings["bins"], settings["style"], settings["styleVariant"], float(settings["binWidth"]))
+    if settings["polarWarp"]:
+        min_radius, max_radius = settings["innerOuterRadius"]
+        get_polar_maps(height, width, float(min_radius), float(max_radius), get_polar_interpolation(settings))
+
 def render_volume(data, settings):
     color = hex_to_bgr(settings["color"])
     bg_color = hex_to_bgr(settings["backgroundColor"])
@@ -16,77 +42,58 @@ def render_volume(data, settings):
 
     smallest_side = min(height, width)
     min_radius, max_radius = settings["innerOuterRadius"]
-    radius = int(smallest_side/2 * (min_radius + (data * (max_radius - min_radius))))
-
     midpoint = (width//2, height//2)
+    if is_native_anti_aliasing(settings):
+        coverage = np.zeros((height, width), dtype=np.float32)
+        add_circle(coverage, width/2, height/2, smallest_side/2 * (min_radius + (data * (max_radius - min_radius))))
+        if (min_radius > 0):
+            add_circle(coverage, width/2, height/2, smallest_side/2 * min_radius, cut=True)
+        return paint_coverage(np.rint(coverage * 255).astype(np.uint8)[None], color, bg_color)[0]
+
+    radius = int(smallest_side/2 * (min_radius + (data * (max_radius - min_radius))))
     cv2.circle(img, midpoint, radius, color, -1)
     if (min_radius > 0):
         cv2.circle(img, midpoint, int(smallest_side/2 * min_radius), bg_color, -1)
-    if (settings["antiAliasing"]):
-        img = cv2.resize(img, (settings["width"], settings["height"]))
-    return img
+    return downscale(img, settings)
+
+def render_frames(frames, settings):
+    # Renders a batch of frames, the bar and point styles are rasterized in one pass
+    rasterize = get_rasterizer(settings)
+    if rasterize is not None:
+        color = hex_to_bgr(settings["color"])
+        bg_color = hex_to_bgr(settings["backgroundColor"])
+        images = rasterize(frames, settings, get_canvas_size(settings), color, bg_color)
+        return [finish_spectrum(img, settings) for img in images]
+    return [render_frame(data, settings) for data in frames]
+
+def get_rasterizer(settings):
+    # Vectorized drawing of a batch of frames, None for styles that are drawn frame by frame
+    if settings["visualization"] != "spectrum":
+        return None
+    if is_native_anti_aliasing(settings):
+        if can_rasterize_coverage(settings):
+            return rasterize_coverage
+        # LCD segments are aligned to the pixel grid, there are no edges to smooth
+        if settings["styleVariant"] == "lcd":
+            return rasterize_spectrum
+        return None
+    return rasterize_spectrum if can_rasterize(settings) else None
 
 def render_spectrum(data, settings):
     color = hex_to_bgr(settings["color"])
     bg_color = hex_to_bgr(settings["backgroundColor"])
+
+    rasterize = get_rasterizer(settings)
+    if rasterize is not None:
+        img = rasterize(np.asarray(data)[None], settings, get_canvas_size(settings), color, bg_color)[0]
+        return finish_spectrum(img, settings)
+
     img = initialImage(settings, bg_color)
     height, width, channels = img.shape
 
     num_bins = len(data)
-    if settings["style"] == "bar":
-        for i, value in enumerate(data):
-            if (settings["styleVariant"] == "simple"):
-                bar_height = int(height * value)
-                bin_width = width / num_bins
-                offset = bin_width * (1 - settings["binWidth"]) / 2
-                x1 = int(bin_width * i + offset)
-                x2 = int(bin_width * (i + 1) - offset)
-                y1 = height - bar_height
-                y2 = height
-                cv2.rectangle(img, (x1, y1), (x2, y2), color, -1)
-
-            elif (settings["styleVariant"] == "lcd"):
-                bin_width = width / num_bins
-                offset = bin_width * (1 - settings["binWidth"]) / 2
-                row_height = int(bin_width - 2 * offset)
-                max_rows = height / row_height
-                rows = int(round(value * max_rows))
-                for row in range(rows):
-                    x1 = int(bin_width * i + offset)
-                    x2 = int(bin_width * (i + 1) - offset)
-                    y1 = height - int(row_height * (row + 0.5)) + 1
-                    y2 = height - int(row_height * row)
-                    cv2.rectangle(img, (x1, y1), (x2, y2), color, -1)
-
-    elif settings["style"] == "point":
-        for i, value in enumerate(data):
-            if (settings["styleVariant"] == "circle"):
-                radius = width / num_bins / 2
-                x = int(width / num_bins * i + radius)
-                point_height = int(height * value - radius)
-                midpoint = (x, height - point_height)
-                cv2.circle(img, midpoint, int(radius * settings["binWidth"]), color, -1)
-            elif (settings["styleVariant"] == "square"):
-                bar_height = int(height * value)
-                bin_width = width / num_bins
-                offset = bin_width * (1 - settings["binWidth"]) / 2
-                x1 = int(bin_width * i + offset)
-                x2 = int(bin_width * (i + 1) - offset)
-                y1 = height - bar_height
-                y2 = height - bar_height + int(bin_width - 2 * offset)
-                cv2.rectangle(img, (x1, y1), (x2, y2), color, -1)
-            elif (settings["styleVariant"] == "donut"):
-                radius = width / num_bins / 2
-                x = int(width / num_bins * i + radius)
-                point_height = int(height * value - radius)
-                midpoint = (x, height - point_height)
-                cv2.circle(img, midpoint, int(radius * settings["binWidth"]), color, -1)
-                cv2.circle(img, midpoint, int(radius * settings["binWidth"] / 2), bg_color, -1)
-
-    elif settings["style"] == "line":
-        lineThickness = settings["lineThickness"]
-        if (settings["antiAliasing"]):
-            lineThickness = settings["lineThickness"] * 2
+    if settings["style"] == "line":
+        lineThickness = settings["lineThickness"] * get_supersampling(settings)
         bin_width = width / num_bins
         x_coords = [int(bin_width * i) for i in range(len(data) + 1)]
         y_coords = (
@@ -103,60 +110,67 @@ def render_spectrum(data, settings):
             , dtype=np.int32)
             cv2.fillPoly(img, [polygon], color)
 
+    return finish_spectrum(img, settings)
+
+def finish_spectrum(img, settings):
     if (settings["polarWarp"]):
         img = polar_warp(img, settings)
-    if (settings["antiAliasing"]):
-        img = cv2.resize(img, (settings["width"], settings["height"]))
-    return img
+    return downscale(img, settings)
+
+def downscale(img, settings):
+    factor = get_supersampling(settings)
+    if factor == 1:
+        return img
+    # Halving with linear interpolation averages 2x2 blocks, other factors need area averaging
+    interpolation = cv2.INTER_LINEAR if factor == 2 else cv2.INTER_AREA
+    return cv2.resize(img, (settings["width"], settings["height"]), interpolation=interpolation)
+
+def is_native_anti_aliasing(settings):
+    return settings["antiAliasing"] and get_anti_aliasing_mode(settings) == "native"
+
+def get_anti_aliasing_mode(settings):
+    mode = settings.get("antiAliasingMode", "supersample")
+    if mode not in ANTI_ALIASING_MODES:
+        raise ValueError(f"Unknown anti-aliasing mode: {mode}")
+    return mode
+
+def get_supersampling(settings):
+    # Factor the canvas is larger than the video
+    if not settings["antiAliasing"] or get_anti_aliasing_mode(settings) == "native":
+        return 1
+    factor = int(settings.get("supersampling", 2))
+    if factor not in SUPERSAMPLING_FACTORS:
+        raise ValueError(f"Supersampling must be one of {SUPERSAMPLING_FACTORS}, not {factor}")
+    return factor
+
+def get_canvas_size(settings):
+    factor = get_supersampling(settings)
+    return settings["height"] * factor, settings["width"] * factor
 
 def initialImage(settings, bg_color):
-    height = settings["height"]
-    width = settings["width"]
-    if (settings["antiAliasing"]):
-        height = height * 2
-        width = width * 2
-
+    height, width = get_canvas_size(settings)
     return np.full((height, width, 3), bg_color, dtype=np.uint8)
 
+@functools.lru_cache(maxsize=64)
 def hex_to_bgr(hex_color):
-    rgb = mcolors.to_rgb(hex_color)
-    rgb = [int(x * 255) for x in rgb] 
-    return tuple(reversed(rgb))
+    # "#rgb", "#rrggbb" or with alpha, which is ignored. Parsed by hand, matplotlib
+    # takes longer to import than every render worker needs to start otherwise.
+    match = re.fullmatch(r"#([0-9a-fA-F]{3,4}|[0-9a-fA-F]{6}|[0-9a-fA-F]{8})", hex_color)
+    if match is None:
+        raise ValueError(f"Invalid hex color: {hex_color}")
+    digits = match.group(1)
+    if len(digits) <= 4:
+        digits = "".join(digit * 2 for digit in digits)
+    red, green, blue = (int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    return (blue, green, red)
 
 def polar_warp(img, settings):
-    original_height, original_width = img.shape[:2]
-    size = min(original_height, original_width)
-    center = size / 2
-    min_radius, max_radius = settings["innerOuterRadius"]
-
-    y_indices, x_indices = np.indices((size, size))
-    dx = x_indices - center
-    dy = y_indices - center
-    distance = np.sqrt(dx**2 + dy**2)
-    inner_radius = min_radius * (size / 2)
-    outer_radius = max_radius * size / 2
-    angle = (np.arctan2(dy, dx) + np.pi / 2) % (2 * np.pi)
-
-    mask = (distance >= inner_radius) & (distance <= outer_radius)
-    norm_radius = (distance - inner_radius) / (outer_radius - inner_radius)
-    norm_radius = np.clip(norm_radius, 0, 1)
-
-    target_y = (original_height * (1 - norm_radius)).astype(np.int32)
-    target_x = (angle / (2 * np.pi) * original_width).astype(np.int32)
-
-    target_y = np.clip(target_y, 0, original_height - 1)
-    target_x = np.clip(target_x, 0, original_width - 1)
-
     bg_color = hex_to_bgr(settings["backgroundColor"])
-    warped_img = np.full((size, size, 3), fill_value=bg_color)
-    warped_img[mask] = img[target_y[mask], target_x[mask]]
-
-    new_img = initialImage(settings, bg_color)
-    offset_y = (new_img.shape[0] - size) // 2
-    offset_x = (new_img.shape[1] - size) // 2
-    new_img[offset_y:offset_y+size, offset_x:offset_x+size] = warped_img
-
-    return new_img
+    min_radius, max_radius = settings["innerOuterRadius"]
+    interpolation = get_polar_interpolation(settings)
+    map_x, map_y = get_polar_maps(img.shape[0], img.shape[1], float(min_radius), float(max_radius), interpolation)
+    cv_interpolation = cv2.INTER_LINEAR if interpolation == "bilinear" else cv2.INTER_NEAREST
+    return cv2.remap(img, map_x, map_y, cv_interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=bg_color)
 
     if (0):
         original_height, original_width = img.shape[:2]
@@ -189,3 +203,45 @@ def polar_warp(img, settings):
         new_img[offset_y:offset_y+warped_img.shape[0],offset_x:offset_x+warped_img.shape[1]] = warped_img
 
         return new_img
+
+def get_polar_interpolation(settings):
+    # Native anti-aliasing has no supersampled canvas that hides nearest neighbour sampling
+    return settings.get("polarInterpolation", "bilinear" if is_native_anti_aliasing(settings) else "nearest")
+
+@functools.lru_cache(maxsize=8)
+def get_polar_maps(original_height, original_width, min_radius, max_radius, interpolation):
+    # Maps every pixel of the output canvas to its source pixel in the unwarped image.
+    # Pixels outside the ring get a negative coordinate, which remap fills with the background.
+    size = min(original_height, original_width)
+    center = size / 2
+    offset_y = (original_height - size) // 2
+    offset_x = (original_width - size) // 2
+
+    y_indices, x_indices = np.indices((original_height, original_width), dtype=np.float64)
+    dx = x_indices - offset_x - center
+    dy = y_indices - offset_y - center
+    distance = np.sqrt(dx**2 + dy**2)
+    inner_radius = min_radius * (size / 2)
+    outer_radius = max_radius * size / 2
+    angle = (np.arctan2(dy, dx) + np.pi / 2) % (2 * np.pi)
+
+    inside = (
+        (x_indices >= offset_x) & (x_indices < offset_x + size) &
+        (y_indices >= offset_y) & (y_indices < offset_y + size)
+    )
+    mask = inside & (distance >= inner_radius) & (distance <= outer_radius)
+    norm_radius = (distance - inner_radius) / (outer_radius - inner_radius) if outer_radius > inner_radius else np.zeros_like(distance)
+    norm_radius = np.clip(norm_radius, 0, 1)
+
+    target_y = original_height * (1 - norm_radius)
+    target_x = angle / (2 * np.pi) * original_width
+    if interpolation != "bilinear":
+        target_y = np.floor(target_y)
+        target_x = np.floor(target_x)
+
+    target_y = np.clip(target_y, 0, original_height - 1)
+    target_x = np.clip(target_x, 0, original_width - 1)
+    target_y[~mask] = -original_height
+    target_x[~mask] = -original_width
+
+    return target_x.astype(np.float32), target_y.astype(np.float32)
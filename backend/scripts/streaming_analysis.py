@@ -0,0 +1,171 @@
+import numpy as np
+import soundfile as sf
+import audioread
+
+# Block-wise audio analysis with memory use independent of the track length.
+#
+# The audio is decoded a block at a time and cut into the same frames librosa.stft
+# produces for n_fft == hop_length with centering, so the results match get_analysis
+# on the fully loaded signal. The analysis rows are handed on block by block, which
+# lets the caller write them straight to disk. SciPy takes most of a second to import
+# and is only imported once audio is analyzed, not when the server starts.
+
+# Video frames analyzed per block
+BLOCK_FRAMES = 1024
+
+# Audio samples decoded at once
+DECODE_BLOCK_SAMPLES = 1 << 20
+
+def iter_analysis_blocks(file_path, start, end, settings, block_frames=BLOCK_FRAMES):
+    # Returns the sample rate and a generator of analysis rows, one row per video frame.
+    # Rows are magnitude spectra within the frequency range for spectrum, and the RMS
+    # within the frequency range for volume.
+    sr, blocks = iter_audio_blocks(file_path, start, end, DECODE_BLOCK_SAMPLES)
+    samples_per_frame = sr // settings["framerate"]
+
+    freqs = np.fft.rfftfreq(samples_per_frame, d=1 / sr)
+    min_freq, max_freq = settings["minMaxFrequency"]
+    valid_indices = np.where((freqs >= min_freq) & (freqs <= max_freq))[0]
+    band_weights = get_band_weights(sr, samples_per_frame, [settings["minMaxFrequency"]])
+
+    def analysis_blocks():
+        for stft_block in iter_stft_blocks(blocks, samples_per_frame, block_frames):
+            if settings["visualization"] == "volume":
+                yield get_band_rms(np.abs(stft_block), band_weights)[:, 0]
+            elif settings["visualization"] == "spectrum":
+                yield np.abs(stft_block[:, valid_indices])
+
+    return sr, analysis_blocks()
+
+def iter_band_volume_blocks(file_path, start, end, framerate, bands, block_frames=BLOCK_FRAMES):
+    # RMS of several frequency bands, e.g. [[20, 250], [250, 4000], [4000, 20000]] for
+    # bass, mid and high, from a single STFT. Yields blocks of shape (frames, bands).
+    sr, blocks = iter_audio_blocks(file_path, start, end, DECODE_BLOCK_SAMPLES)
+    samples_per_frame = sr // framerate
+    band_weights = get_band_weights(sr, samples_per_frame, bands)
+
+    def volume_blocks():
+        for stft_block in iter_stft_blocks(blocks, samples_per_frame, block_frames):
+            yield get_band_rms(np.abs(stft_block), band_weights)
+
+    return sr, volume_blocks()
+
+def iter_audio_blocks(file_path, start, end, block_samples):
+    # Decodes the range like librosa.load(sr=None, mono=True, offset=start, duration=end - start)
+    try:
+        sound_file = sf.SoundFile(file_path)
+    except sf.LibsndfileError:
+        return iter_audioread_blocks(file_path, start, end, block_samples)
+
+    sr = sound_file.samplerate
+
+    def blocks():
+        with sound_file:
+            if start:
+                sound_file.seek(int(start * sr))
+            remaining = int((end - start) * sr)
+            while remaining > 0:
+                block = sound_file.read(frames=min(block_samples, remaining), dtype="float32", always_2d=True)
+                if len(block) == 0:
+                    break
+                remaining -= len(block)
+                yield block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+
+    return sr, blocks()
+
+def iter_audioread_blocks(file_path, start, end, block_samples):
+    reader = audioread.audio_open(file_path)
+    sr = reader.samplerate
+    channels = reader.channels
+
+    def blocks():
+        with reader:
+            sample_start = int(sr * start) * channels
+            sample_end = sample_start + int(sr * (end - start)) * channels
+            position = 0
+            pending = []
+            pending_length = 0
+            for buffer in reader:
+                samples = np.frombuffer(buffer, dtype="<i2").astype(np.float32) / 32768
+                buffer_start = position
+                position += len(samples)
+                if position <= sample_start:
+                    continue
+                if buffer_start >= sample_end:
+                    break
+                samples = samples[max(sample_start - buffer_start, 0):sample_end - buffer_start]
+                pending.append(samples)
+                pending_length += len(samples)
+                if pending_length >= block_samples * channels:
+                    yield to_mono(np.concatenate(pending), channels)
+                    pending = []
+                    pending_length = 0
+            if pending:
+                yield to_mono(np.concatenate(pending), channels)
+
+    return sr, blocks()
+
+def to_mono(samples, channels):
+    if channels == 1:
+        return samples
+    return samples.reshape(-1, channels).mean(axis=1)
+
+def iter_stft_blocks(sample_blocks, n_fft, block_frames):
+    # Centered STFT with hop_length == n_fft. Frames do not overlap, so a frame only
+    # needs the samples that are left over from the previous block.
+    from scipy.signal import get_window
+    window = get_window("hann", n_fft, fftbins=True).astype(np.float32)
+    pad = n_fft // 2
+    buffer = np.zeros(pad, dtype=np.float32)
+    total_samples = 0
+    emitted = 0
+
+    for block in sample_blocks:
+        total_samples += len(block)
+        buffer = np.concatenate([buffer, block])
+        num_frames = len(buffer) // n_fft
+        if num_frames:
+            for i in range(0, num_frames, block_frames):
+                frames = buffer[i * n_fft:min(i + block_frames, num_frames) * n_fft].reshape(-1, n_fft)
+                yield np.fft.rfft(frames * window, axis=1).astype(np.complex64)
+            emitted += num_frames
+            buffer = buffer[num_frames * n_fft:]
+
+    # Remaining frames, zero padded at the end like librosa does
+    total_frames = 1 + (total_samples + 2 * pad - n_fft) // n_fft
+    if total_frames > emitted:
+        missing = total_frames - emitted
+        buffer = np.concatenate([buffer, np.zeros(missing * n_fft - len(buffer), dtype=np.float32)])
+        yield np.fft.rfft(buffer.reshape(missing, n_fft) * window, axis=1).astype(np.complex64)
+
+def get_band_weights(sr, n_fft, bands):
+    # (frequencies, bands) matrix that turns squared STFT magnitudes into the RMS of
+    # every band. By Parseval's theorem the energy of a windowed frame is the sum of its
+    # squared magnitudes, where the bins between DC and Nyquist count twice because the
+    # one-sided spectrum leaves out their negative counterparts. Dividing by the energy
+    # of the window gives the mean square of the signal itself, weighted by the window.
+    #
+    # This matches librosa.istft followed by librosa.feature.rms for the full frequency
+    # range. For narrower ranges, or an odd n_fft, it deliberately differs from the old
+    # analysis: with hop_length == n_fft, the istft divided the frame edges by the
+    # squared window, which reported many times the RMS of a steady tone within the
+    # range. tests/test_analysis.py compares both with a band-pass by overlapping frames.
+    freqs = np.fft.rfftfreq(n_fft, d=1 / sr)
+    one_sided = np.full(len(freqs), 2.0)
+    one_sided[0] = 1
+    if n_fft % 2 == 0:
+        one_sided[-1] = 1
+
+    from scipy.signal import get_window
+    window = get_window("hann", n_fft, fftbins=True)
+    scale = one_sided / (n_fft * np.sum(window ** 2))
+
+    weights = np.zeros((len(freqs), len(bands)), dtype=np.float32)
+    for band, (min_freq, max_freq) in enumerate(bands):
+        in_band = (freqs >= min_freq) & (freqs <= max_freq)
+        weights[in_band, band] = scale[in_band]
+    return weights
+
+def get_band_rms(magnitude, band_weights):
+    # (frames, frequencies) magnitudes -> (frames, bands) RMS
+    return np.sqrt((magnitude ** 2) @ band_weights)
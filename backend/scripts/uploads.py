@@ -0,0 +1,162 @@
+import soundfile as sf
+
+import os
+import re
+import json
+import uuid
+import threading
+import subprocess
+
+# Content addressed storage for uploaded audio.
+#
+# An upload is streamed to a temporary file while its SHA-256 is computed, and then
+# renamed to the hash, so a track that is uploaded again under any name takes no
+# space and clients that know the hash can skip the upload entirely. The index maps
+# the names clients use to these files and keeps the duration and sample rate of
+# every file, which are probed once instead of on every request.
+
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+# FFmpeg codec names of the formats libsndfile reads, PCM formats are left out because
+# they are never copied into a video
+SOUNDFILE_CODECS = {"FLAC": "flac", "OGG": "vorbis", "MP3": "mp3"}
+
+class UploadIndex:
+    def __init__(self, store, index_path):
+        self.store = store
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._names = {}
+        self._info = {}
+        self._load()
+
+    def get_temp_path(self):
+        return self.store.path(f".upload-{uuid.uuid4().hex}.part")
+
+    def add(self, temp_path, content_hash, name):
+        # Stores a completely written temporary file under its hash and remembers the
+        # name it was uploaded as. Returns the name of the stored file.
+        filename = get_stored_filename(content_hash, name)
+        path = self.store.path(filename)
+        with self.store.pin(path):
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                self.store.add(temp_path, filename)
+        self.add_name(name, filename)
+        return filename
+
+    def remove(self, filename):
+        # Deletes a stored file and forgets every name of it
+        try:
+            os.remove(self.store.path(filename))
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._names = {name: stored for name, stored in self._names.items() if stored != filename}
+            self._info.pop(filename, None)
+            self._save()
+
+    def find(self, content_hash, name=None):
+        # Name of the stored file with this content, or None if there is none
+        with self._lock:
+            filenames = {filename for filename in self._names.values() if filename.startswith(content_hash)}
+        filenames.add(get_stored_filename(content_hash, name or ""))
+        for filename in filenames:
+            if os.path.exists(self.store.path(filename)):
+                return filename
+        return None
+
+    def add_name(self, name, filename):
+        with self._lock:
+            self._names[name] = filename
+            self._save()
+
+    def resolve(self, name):
+        # Stored file of a name clients used, other files (e.g. downloads) keep their name
+        with self._lock:
+            filename = self._names.get(name)
+        if filename is not None and os.path.exists(self.store.path(filename)):
+            return filename
+        return name
+
+    def get_info(self, filename):
+        path = self.store.path(filename)
+        stat = os.stat(path)
+        with self._lock:
+            info = self._info.get(filename)
+        # Entries of older versions lack the codec and are probed again
+        if info is None or info["size"] != stat.st_size or info["mtime_ns"] != stat.st_mtime_ns or "codec" not in info:
+            info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, **probe_audio(path)}
+            with self._lock:
+                self._info[filename] = info
+                self._save()
+        return {"duration": info["duration"], "sample_rate": info["sample_rate"], "channels": info["channels"], "codec": info["codec"]}
+
+    def get_codec(self, path):
+        return self.get_info(os.path.basename(path))["codec"]
+
+    def get_sample_rate(self, path):
+        return self.get_info(os.path.basename(path))["sample_rate"]
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self._names = index.get("names", {})
+        self._info = index.get("info", {})
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = f"{self.index_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"names": self._names, "info": self._info}, f)
+        os.replace(temp_path, self.index_path)
+
+def get_stored_filename(content_hash, name):
+    # The extension is kept as a hint for the decoders
+    extension = os.path.splitext(name)[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,5}", extension):
+        extension = ""
+    return content_hash + extension
+
+def is_content_hash(value):
+    return isinstance(value, str) and re.fullmatch(r"[0-9a-f]{64}", value) is not None
+
+def probe_audio(path):
+    # Raises ValueError for files without a readable audio stream
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v", "error",
+                "-select_streams", "a:0",
+                "-show_entries", "stream=codec_name,sample_rate,channels:format=duration",
+                "-of", "json",
+                path,
+            ],
+            capture_output=True,
+            check=True,
+        )
+    except FileNotFoundError:
+        # Without FFmpeg installed only formats libsndfile reads can be probed
+        try:
+            info = sf.info(path)
+        except sf.LibsndfileError:
+            raise ValueError("Not a readable audio file")
+        return {"duration": info.duration, "sample_rate": info.samplerate, "channels": info.channels, "codec": SOUNDFILE_CODECS.get(info.format)}
+    except subprocess.CalledProcessError:
+        raise ValueError("Not a readable audio file")
+
+    probe = json.loads(result.stdout)
+    if not probe.get("streams") or "duration" not in probe.get("format", {}):
+        raise ValueError("Not a readable audio file")
+    stream = probe["streams"][0]
+    return {
+        "duration": float(probe["format"]["duration"]),
+        "sample_rate": int(stream["sample_rate"]),
+        "channels": int(stream["channels"]),
+        "codec": stream.get("codec_name"),
+    }
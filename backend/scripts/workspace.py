@@ -0,0 +1,128 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+import collections
+
+# Files the server creates on the fly.
+#
+# Every render works in a private scratch directory, so that concurrent renders never
+# touch each other's intermediate files, and the directory is removed however the
+# render ends. Uploads and finished videos are kept in directories that behave like
+# LRU caches: the least recently used files are deleted when a directory grows beyond
+# its byte quota or a file has not been used for too long. Files that a running job
+# uses are pinned and never deleted.
+
+class FileStore:
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evictions = 0
+        self._pins = collections.Counter()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @contextlib.contextmanager
+    def pin(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            self._pins[path] += 1
+        try:
+            self.touch(path)
+            yield path
+        finally:
+            with self._lock:
+                self._pins[path] -= 1
+                if self._pins[path] <= 0:
+                    del self._pins[path]
+
+    def is_pinned(self, path):
+        with self._lock:
+            return os.path.abspath(path) in self._pins
+
+    def touch(self, path):
+        # The access time marks the last use. The modification time stays as it is,
+        # because it identifies the content of the file (e.g. for the analysis cache).
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    def add(self, source_path, filename):
+        # Moves a finished file into the store, replacing a file of the same name
+        path = self.path(filename)
+        os.replace(source_path, path)
+        self.touch(path)
+        self.evict()
+        return path
+
+    def evict(self):
+        now = time.time()
+        entries = self._list_entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, last_used in sorted(entries, key=lambda entry: entry[2]):
+            expired = self.max_age is not None and now - last_used > self.max_age
+            over_quota = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not over_quota:
+                break
+            if self.is_pinned(path):
+                continue
+            try:
+                os.remove(path)
+            except (FileNotFoundError, PermissionError):
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        entries = self._list_entries()
+        with self._lock:
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "pinned": len(self._pins),
+                "evictions": self.evictions,
+                "max_bytes": self.max_bytes,
+                "max_age": self.max_age,
+            }
+
+    def _list_entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((os.path.abspath(entry.path), stat.st_size, stat.st_atime))
+        return entries
+
+class Workspaces:
+    def __init__(self, directory):
+        self.directory = directory
+
+    @contextlib.contextmanager
+    def create(self, prefix="job-"):
+        os.makedirs(self.directory, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=prefix, dir=self.directory)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def clean(self):
+        # Removes what renders of an earlier run left behind, only safe while no job runs
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
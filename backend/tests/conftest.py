@@ -0,0 +1,27 @@
+import numpy as np
+import soundfile as sf
+import pytest
+
+import main
+import scripts.entrypoint as entrypoint
+import scripts.preview as preview
+from scripts.analysis_cache import AnalysisCache
+from scripts.uploads import UploadIndex
+from scripts.workspace import FileStore
+
+@pytest.fixture
+def stored_track(tmp_path, monkeypatch):
+    # A two second sweep in an upload store of its own, with an analysis cache of its
+    # own. Returns the name it is stored under.
+    store = FileStore(str(tmp_path / "upload"))
+    index = UploadIndex(store, str(tmp_path / "uploads.json"))
+    cache = AnalysisCache(str(tmp_path / "analysis"), 1 << 30)
+    for module in (main, entrypoint, preview):
+        monkeypatch.setattr(module, "upload_store", store)
+        monkeypatch.setattr(module, "upload_index", index)
+        monkeypatch.setattr(module, "analysis_cache", cache)
+
+    sr = 44100
+    t = np.arange(2 * sr) / sr
+    sf.write(store.path("sweep.wav"), (0.5 * np.sin(2 * np.pi * (100 + 2000 * t) * t)).astype(np.float32), sr)
+    return "sweep.wav"
@@ -0,0 +1,105 @@
+import librosa
+import numpy as np
+import soundfile as sf
+import pytest
+
+from scripts.entrypoint import get_analysis
+from scripts.streaming_analysis import iter_analysis_blocks, iter_band_volume_blocks
+
+# Band-limited volume from STFT magnitudes against librosa.istft followed by
+# librosa.feature.rms. With hop_length == n_fft, as the old volume analysis used, the
+# istft divides the frame edges by the squared window, which is only harmless for the
+# full frequency range and an even n_fft. Everywhere else the reference band-passes with
+# overlapping frames, which reconstructs the band without that division.
+
+SR = 44100
+DURATION = 4
+
+def get_signals():
+    t = np.arange(SR * DURATION) / SR
+    rng = np.random.default_rng(0)
+    return {
+        "tone": 0.5 * np.sin(2 * np.pi * 440 * t),
+        "noise": 0.3 * rng.standard_normal(len(t)),
+        "decay": np.exp(-1.5 * t) * np.sin(2 * np.pi * 220 * t),
+    }
+
+def get_volume(y, framerate, band):
+    return get_analysis(y, SR, {"visualization": "volume", "framerate": framerate, "minMaxFrequency": band})
+
+def get_istft_volume(y, n_fft, hop_length, band):
+    stft = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+    freqs = librosa.fft_frequencies(sr=SR, n_fft=n_fft)
+    stft[(freqs < band[0]) | (freqs > band[1])] = 0
+    filtered_y = librosa.istft(stft, n_fft=n_fft, hop_length=hop_length, length=len(y))
+    return librosa.feature.rms(y=filtered_y, frame_length=n_fft, hop_length=n_fft)[0]
+
+def normalize(rms):
+    # As normalize_frames scales volume
+    db = librosa.amplitude_to_db(rms, ref=np.max(rms))
+    return np.clip((db + 60) / 60, 0, 1)
+
+@pytest.mark.parametrize("name", ["tone", "noise", "decay"])
+def test_full_band_volume_matches_old_istft_volume(name):
+    y = get_signals()[name].astype(np.float32)
+    n_fft = SR // 30
+    expected = get_istft_volume(y, n_fft, n_fft, [0, SR / 2])
+    volume = get_volume(y, 30, [0, SR / 2])
+
+    assert len(volume) == len(expected)
+    assert np.max(np.abs(normalize(volume) - normalize(expected))) < 0.01
+
+@pytest.mark.parametrize("name", ["tone", "noise", "decay"])
+@pytest.mark.parametrize("framerate", [24, 30, 60])
+@pytest.mark.parametrize("band", [[20, 20000], [200, 2000]])
+def test_band_volume_matches_istft_volume(name, framerate, band):
+    # The hann window weights the middle of a frame more than the flat RMS does, which
+    # shows in the short frames of band-limited noise
+    y = get_signals()[name].astype(np.float32)
+    n_fft = SR // framerate
+    expected = get_istft_volume(y, n_fft, n_fft // 4, band)
+    volume = get_volume(y, framerate, band)
+
+    assert len(volume) == len(expected)
+    difference = np.abs(normalize(volume) - normalize(expected))
+    assert np.max(difference) < 0.06
+    assert np.mean(difference) < 0.015
+
+def test_band_volume_of_steady_tone_is_its_rms():
+    # The old analysis reported about nine times the RMS for most frames of this tone
+    y = get_signals()["tone"].astype(np.float32)
+    volume = get_volume(y, 30, [200, 2000])
+
+    # The first and last frames are half padding
+    assert np.allclose(volume[1:-1], 0.5 / np.sqrt(2), rtol=0.01)
+
+@pytest.mark.parametrize("visualization", ["volume", "spectrum"])
+def test_streaming_analysis_matches_in_memory_analysis(tmp_path, visualization):
+    y = get_signals()["noise"].astype(np.float32)
+    path = tmp_path / "noise.wav"
+    sf.write(path, y, SR, subtype="FLOAT")
+    settings = {"visualization": visualization, "framerate": 30, "minMaxFrequency": [200, 2000]}
+
+    sr, blocks = iter_analysis_blocks(str(path), 0, DURATION, settings, block_frames=16)
+    streamed = np.concatenate(list(blocks))
+
+    assert sr == SR
+    assert np.allclose(streamed, get_analysis(y, SR, settings), rtol=1e-4, atol=1e-6)
+
+def test_band_volumes_add_up_to_full_band_volume(tmp_path):
+    # By Parseval's theorem, bands that split the spectrum without overlapping split its
+    # energy, so their squared RMS add up to the squared RMS of the full band. The edges
+    # fall between the 30 Hz bins of 30 frames per second.
+    y = get_signals()["noise"].astype(np.float32)
+    path = tmp_path / "noise.wav"
+    sf.write(path, y, SR, subtype="FLOAT")
+    bands = [[0, 255], [255, 4005], [4005, SR / 2]]
+
+    sr, blocks = iter_band_volume_blocks(str(path), 0, DURATION, 30, bands, block_frames=16)
+    band_volume = np.concatenate(list(blocks))
+    full_volume = get_volume(y, 30, [0, SR / 2])
+
+    assert sr == SR
+    assert band_volume.shape == (len(full_volume), len(bands))
+    assert np.all(band_volume > 0)
+    assert np.allclose(np.sum(band_volume ** 2, axis=1), full_volume ** 2, rtol=1e-4)
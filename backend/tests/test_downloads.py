@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+import concurrent.futures
+
+import pytest
+
+from scripts.downloads import DownloadManager
+from scripts.workspace import FileStore, Workspaces
+
+class StubExtractor:
+    # Stands in for yt-dlp. Extractions and downloads wait for release, so that tests
+    # can make requests while they are in flight.
+    def __init__(self):
+        self.extractions = 0
+        self.downloads = 0
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.fail = False
+
+    def extract_info(self, url):
+        self.extractions += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("Video unavailable")
+        return {"entries": [{"id": "abc", "title": "Title", "original_url": url}]}
+
+    def download_audio(self, video_id, output_path, progress):
+        self.downloads += 1
+        with open(output_path + ".mp3", "wb") as f:
+            self.started.set()
+            while not self.release.wait(0.01):
+                progress("download", f.tell(), 100)
+                f.write(b"x")
+            progress("convert")
+
+@pytest.fixture
+def extractor():
+    return StubExtractor()
+
+@pytest.fixture
+def store(tmp_path):
+    return FileStore(str(tmp_path / "upload"))
+
+@pytest.fixture
+def workspaces(tmp_path):
+    return Workspaces(str(tmp_path / "workspace"))
+
+@pytest.fixture
+def manager(store, workspaces, extractor):
+    manager = DownloadManager(store, workspaces, extractor=extractor, metadata_ttl=60)
+    yield manager
+    extractor.release.set()
+    manager.shutdown()
+
+def test_concurrent_metadata_requests_extract_once(manager, extractor):
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(manager.get_metadata, "https://youtu.be/abc") for _ in range(8)]
+        extractor.started.wait(5)
+        # Lets the other requests arrive while the extraction is in flight
+        time.sleep(0.1)
+        extractor.release.set()
+        results = [future.result() for future in futures]
+
+    assert extractor.extractions == 1
+    assert all(result == {"title": "Title", "uploader": None, "duration": None, "url": "https://youtu.be/abc", "thumbnail": None, "id": "abc"} for result in results)
+    assert manager.stats()["metadata"] == {"hits": 7, "misses": 1, "entries": 1}
+
+def test_metadata_is_extracted_again_after_ttl(store, workspaces, extractor):
+    extractor.release.set()
+    manager = DownloadManager(store, workspaces, extractor=extractor, metadata_ttl=0.1)
+    manager.get_metadata("https://youtu.be/abc")
+    manager.get_metadata("https://youtu.be/abc")
+    assert extractor.extractions == 1
+
+    time.sleep(0.2)
+    manager.get_metadata("https://youtu.be/abc")
+    assert extractor.extractions == 2
+    manager.shutdown()
+
+def test_failed_metadata_is_not_cached(manager, extractor):
+    extractor.release.set()
+    extractor.fail = True
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            manager.get_metadata("https://youtu.be/abc")
+    assert extractor.extractions == 2
+
+    extractor.fail = False
+    assert manager.get_metadata("https://youtu.be/abc")["id"] == "abc"
+
+def test_download_in_flight_is_shared(manager, extractor, store):
+    job = manager.download("abc")
+    extractor.started.wait(5)
+
+    assert manager.download("abc") is job
+    extractor.release.set()
+    job.future.result(5)
+
+    assert job.snapshot()[1]["status"] == "done"
+    assert job.snapshot()[1]["result"] == "abc.mp3"
+    assert extractor.downloads == 1
+    assert os.listdir(store.directory) == ["abc.mp3"]
+    # Stored audio is not downloaded again
+    assert manager.download("abc") is None
+
+def test_cancelled_download_leaves_nothing_behind(manager, extractor, store, workspaces):
+    job = manager.download("abc")
+    extractor.started.wait(5)
+    # The partial file is in the workspace, not in the store
+    assert os.listdir(store.directory) == []
+
+    manager.cancel(job.id)
+    job.future.result(5)
+
+    assert job.snapshot()[1]["status"] == "cancelled"
+    assert os.listdir(store.directory) == []
+    assert os.listdir(workspaces.directory) == []
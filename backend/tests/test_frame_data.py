@@ -0,0 +1,55 @@
+import zlib
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+SETTINGS = {"visualization": "spectrum", "framerate": 30, "startEnd": [0, 10], "minMaxFrequency": [0, 4000], "bins": 64, "smoothing": True}
+
+@pytest.fixture
+def client():
+    # Without the lifespan, no render pool is started
+    return TestClient(main.app)
+
+@pytest.mark.parametrize("body", [
+    {"start": "abc"},
+    {"start": None},
+    {"frames": [1]},
+    {"start": -1},
+    {"frames": 0},
+    {"frames": -30},
+    {"settings": {key: value for key, value in SETTINGS.items() if key != "framerate"}},
+    {"settings": {key: value for key, value in SETTINGS.items() if key != "bins"}},
+    {"settings": {key: value for key, value in SETTINGS.items() if key != "smoothing"}},
+    {"settings": dict(SETTINGS, framerate="fast")},
+    {"settings": dict(SETTINGS, framerate=0)},
+    {"settings": dict(SETTINGS, startEnd="abc")},
+    {"settings": dict(SETTINGS, startEnd=[0])},
+    {"settings": dict(SETTINGS, startEnd=[0, "10"])},
+    {"settings": dict(SETTINGS, minMaxFrequency=None)},
+])
+def test_invalid_frame_data_request_is_rejected(client, body):
+    response = client.post("/frame-data", json={"filename": "missing.wav", "settings": SETTINGS, **body})
+
+    assert response.status_code == 400
+    assert "error" in response.json()
+
+def test_valid_frame_data_request_of_missing_file(client):
+    response = client.post("/frame-data", json={"filename": "missing.wav", "settings": SETTINGS, "start": 0, "frames": 300})
+
+    assert response.status_code == 404
+
+@pytest.mark.parametrize("settings, values", [
+    (dict(SETTINGS, startEnd=[0, 2]), 64),
+    ({key: value for key, value in dict(SETTINGS, visualization="volume", startEnd=[0, 2]).items() if key != "bins"}, 1),
+])
+def test_frame_data_of_track(client, stored_track, settings, values):
+    response = client.post("/frame-data", json={"filename": stored_track, "settings": settings, "start": 0, "frames": 30})
+
+    assert response.status_code == 200
+    assert response.headers["X-Frame-Count"] == "30"
+    assert response.headers["X-Frame-Values"] == str(values)
+    # The test client already undoes the deflate encoding
+    assert len(response.content) == 30 * values
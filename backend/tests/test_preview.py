@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from scripts.benchmark import BASE_SETTINGS
+
+SETTINGS = {**BASE_SETTINGS, "width": 64, "height": 36, "startEnd": [0, 2]}
+
+@pytest.fixture
+def client():
+    # Without the lifespan, no render pool is started
+    return TestClient(main.app)
+
+@pytest.mark.parametrize("settings", [
+    SETTINGS,
+    {key: value for key, value in dict(SETTINGS, visualization="volume").items() if key != "bins"},
+])
+def test_track_preview(client, stored_track, settings):
+    response = client.post("/generate-preview-image", json={"filename": stored_track, "settings": settings, "timestamp": 1})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    image = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_COLOR)
+    assert image.shape == (36, 64, 3)
@@ -0,0 +1,50 @@
+import os
+import signal
+import concurrent.futures
+
+import pytest
+
+from scripts.benchmark import BASE_SETTINGS
+from scripts.render_pool import RenderPool, get_segment_chunk_size, SEGMENT_CHUNK_BYTES, SEGMENT_CHUNK_FRAMES
+
+SETTINGS = {**BASE_SETTINGS, "width": 64, "height": 36, "bins": 8}
+
+def get_frames(num_frames):
+    return [[i / num_frames] * SETTINGS["bins"] for i in range(num_frames)]
+
+@pytest.fixture
+def render_pool():
+    pool = RenderPool(num_workers=2)
+    yield pool
+    pool.shutdown()
+
+def test_render_yields_every_frame_in_order(render_pool):
+    frame_bytes = SETTINGS["width"] * SETTINGS["height"] * 3
+    chunks = list(render_pool.render(get_frames(20), SETTINGS))
+
+    assert sum(num_frames for num_frames, _ in chunks) == 20
+    assert all(len(buffer) == num_frames * frame_bytes for num_frames, buffer in chunks)
+
+def test_render_replaces_pool_after_worker_died(render_pool):
+    frames = render_pool.render(get_frames(200), SETTINGS)
+    next(frames)
+    broken_executor = render_pool.executor
+    os.kill(next(iter(broken_executor._processes)), signal.SIGKILL)
+
+    with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+        for _ in frames:
+            pass
+
+    assert render_pool.executor is not broken_executor
+    assert sum(num_frames for num_frames, _ in render_pool.render(get_frames(20), SETTINGS)) == 20
+
+def test_segment_chunks_shrink_with_the_canvas():
+    small = get_segment_chunk_size(SETTINGS)
+    full_hd = get_segment_chunk_size({**BASE_SETTINGS, "width": 1920, "height": 1080, "antiAliasing": False})
+    supersampled = get_segment_chunk_size({**BASE_SETTINGS, "width": 1920, "height": 1080, "antiAliasing": True, "antiAliasingMode": "supersample", "supersampling": 2})
+    huge = get_segment_chunk_size({**BASE_SETTINGS, "width": 7680, "height": 4320, "antiAliasing": True, "antiAliasingMode": "supersample", "supersampling": 3})
+
+    assert small == SEGMENT_CHUNK_FRAMES
+    assert SEGMENT_CHUNK_FRAMES > full_hd > supersampled >= 1
+    assert supersampled * 3840 * 2160 * 3 <= SEGMENT_CHUNK_BYTES
+    assert huge == 1
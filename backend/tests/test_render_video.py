@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import stat
+
+import numpy as np
+import soundfile as sf
+import pytest
+
+import scripts.entrypoint as entrypoint
+from scripts.analysis_cache import AnalysisCache
+from scripts.benchmark import BASE_SETTINGS, generate_audio
+from scripts.outputs import get_profiles
+from scripts.render_pool import RenderPool
+from scripts.rendering import render_frames
+from scripts.uploads import UploadIndex
+from scripts.workspace import FileStore
+
+SR = 44100
+SETTINGS = {**BASE_SETTINGS, "width": 64, "height": 36, "bins": 16, "startEnd": [0, 2]}
+
+# Saves its standard input as the output file and its arguments next to it
+STUB_FFMPEG = f"""#!{sys.executable}
+import sys, json
+with open(sys.argv[-1], "wb") as f:
+    f.write(sys.stdin.buffer.read())
+with open(sys.argv[-1] + ".json", "w") as f:
+    json.dump(sys.argv[1:], f)
+"""
+
+@pytest.fixture
+def audio_path(tmp_path, monkeypatch):
+    store = FileStore(str(tmp_path / "upload"))
+    monkeypatch.setattr(entrypoint, "upload_index", UploadIndex(store, str(tmp_path / "uploads.json")))
+    monkeypatch.setattr(entrypoint, "analysis_cache", AnalysisCache(str(tmp_path / "analysis"), 1 << 30))
+    path = store.path("sweep.wav")
+    sf.write(path, generate_audio("sweep", 2, SR), SR)
+    return path
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    path = bin_dir / "ffmpeg"
+    path.write_text(STUB_FFMPEG)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+def get_expected_frames(audio_path):
+    analysis = entrypoint.get_cached_analysis(audio_path, SETTINGS)
+    frame_blocks = entrypoint.smooth_blocks(entrypoint.iter_frame_data(analysis, SR, SETTINGS))
+    frame_data = np.concatenate(list(frame_blocks))
+    return [img.tobytes() for img in render_frames(frame_data, SETTINGS)]
+
+@pytest.mark.parametrize("num_workers, segmented", [(2, False), (1, None)])
+def test_streamed_render_writes_every_frame_in_order(tmp_path, audio_path, ffmpeg, num_workers, segmented):
+    output_file = str(tmp_path / "video.mp4")
+    render_pool = RenderPool(num_workers=num_workers)
+    try:
+        entrypoint.render_video(audio_path, SETTINGS, get_profiles(SETTINGS), [output_file], str(tmp_path), render_pool=render_pool, segmented=segmented)
+    finally:
+        render_pool.shutdown()
+
+    with open(output_file + ".json") as f:
+        args = json.load(f)
+    # A single FFmpeg process that reads raw frames from its standard input
+    raw_input = entrypoint.get_raw_video_input(SETTINGS)
+    start = args.index("rawvideo") - 1
+    assert args[start:start + len(raw_input)] == raw_input
+
+    expected = get_expected_frames(audio_path)
+    frame_bytes = SETTINGS["width"] * SETTINGS["height"] * 3
+    with open(output_file, "rb") as f:
+        data = f.read()
+    frames = [data[i:i + frame_bytes] for i in range(0, len(data), frame_bytes)]
+
+    assert len(data) == len(expected) * frame_bytes
+    assert len(frames) == 61
+    # The sweep changes every frame, so frames out of order would not match
+    assert len(set(expected)) > len(expected) // 2
+    assert frames == expected
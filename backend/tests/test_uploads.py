@@ -0,0 +1,30 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def client():
+    # Without the lifespan, no render pool is started
+    return TestClient(main.app)
+
+def test_upload_of_track(client, stored_track):
+    with open(main.upload_store.path(stored_track), "rb") as f:
+        content = f.read()
+
+    response = client.put("/upload-audio/song.wav", content=content)
+
+    assert response.status_code == 200
+    assert response.json()["sample_rate"] == 44100
+    assert main.upload_index.resolve("song.wav") == response.json()["filename"]
+
+def test_upload_of_non_audio_file_is_rejected(client, stored_track):
+    response = client.put("/upload-audio/notes.mp3", content=b"not audio at all" * 100)
+
+    assert response.status_code == 400
+    assert "error" in response.json()
+    # Only the track that was there before is left
+    assert os.listdir(main.upload_store.directory) == [stored_track]
+    assert main.upload_index.resolve("notes.mp3") == "notes.mp3"
@@ -1,7 +1,9 @@
 import axios from "axios"
 
+const baseURL = "http://127.0.0.1:8000"
+
 const apiClient = axios.create({
-  baseURL: "http://127.0.0.1:8000",
+  baseURL,
 })
 
 export const getYTMetaData = async (videoURL) => {
@@ -12,27 +14,45 @@ export const getYTMetaData = async (videoURL) => {
   return response.data
 }
 
-export const uploadAudio = async (formData) => {
-  const response = await apiClient.post("/upload-audio", formData, {
+export const hashFile = async (file) => {
+  const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer())
+  return Array.from(new Uint8Array(digest), (byte) => byte.toString(16).padStart(2, "0")).join("")
+}
+
+export const checkUploadedAudio = async (filename, hash) => {
+  const response = await apiClient.post("/upload-audio/check", {
+    filename,
+    hash,
+  })
+
+  return response
+}
+
+export const uploadAudio = async (file) => {
+  const response = await apiClient.put(`/upload-audio/${encodeURIComponent(file.name)}`, file, {
     headers: {
-      "Content-Type": "multipart/form-data",
+      "Content-Type": "application/octet-stream",
     },
   })
 
   return response
 }
 
-export const uploadAudioFromURL = async (audioURLId) => {
+export const uploadAudioFromURL = async (audioURLId, wait = true) => {
   const response = await apiClient.post("/upload-audio-from-url", {
     audioURLId,
+    wait,
   })
 
   return response
 }
 
-export const generatePreviewImage = async (settings) => {
+export const generatePreviewImage = async (settings, filename = null, timestamp = null) => {
   const response = await apiClient.post("/generate-preview-image", {
     settings: settings,
+    filename,
+    timestamp,
+    format: "jpeg",
   }, {
     responseType: 'arraybuffer'
   })
@@ -40,6 +60,28 @@ export const generatePreviewImage = async (settings) => {
   return response
 }
 
+export const getFrameData = async (filename, settings, start, frames) => {
+  const response = await apiClient.post("/frame-data", {
+    filename,
+    settings,
+    start,
+    frames,
+  }, {
+    responseType: "arraybuffer",
+  })
+
+  // One byte per value, rows of values per frame
+  return {
+    start: Number(response.headers["x-frame-start"]),
+    count: Number(response.headers["x-frame-count"]),
+    values: Number(response.headers["x-frame-values"]),
+    total: Number(response.headers["x-total-frames"]),
+    data: new Uint8Array(response.data),
+  }
+}
+
+export const getAudioURL = (filename) => `${baseURL}/audio/${encodeURIComponent(filename)}`
+
 export const generateVideo = async (filename, settings) => {
   const response = await apiClient.post("/generate-video", {
     filename,
@@ -49,6 +91,32 @@ export const generateVideo = async (filename, settings) => {
   return response
 }
 
+export const watchJob = (jobId, onUpdate, path = "jobs") => {
+  const eventSource = new EventSource(`${baseURL}/${path}/${jobId}/events`)
+  eventSource.onmessage = (event) => {
+    const job = JSON.parse(event.data)
+    if (["done", "failed", "cancelled"].includes(job.status)) {
+      eventSource.close()
+    }
+    onUpdate(job)
+  }
+  eventSource.onerror = () => {
+    eventSource.close()
+    onUpdate({ jobId, status: "failed", error: "Lost connection to the server" })
+  }
+  return eventSource
+}
+
+export const watchDownload = (downloadId, onUpdate) => {
+  return watchJob(downloadId, onUpdate, "downloads")
+}
+
+export const cancelJob = async (jobId) => {
+  const response = await apiClient.post(`/jobs/${jobId}/cancel`)
+
+  return response
+}
+
 export const downloadVideo = async (filename) => {
   const response = await apiClient.get(`/download-video/${filename}`, {
     responseType: "blob",